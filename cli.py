@@ -2,11 +2,21 @@ import os
 import logging
 import asyncio
 import re
-from anthropic import AsyncAnthropic
-from anthropic.types import TextBlock
+import multiprocessing
+import hashlib
+import math
+import importlib.util
+import argparse
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient, DEFAULT_CONNECTION_LIMITS
+import copy
+from anthropic.types import Message, TextBlock, ToolUseBlock
 import json
-from concurrent.futures import ProcessPoolExecutor
-from rich.console import Console
+import fastjsonschema
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Optional
+from rich.console import Console, Group
+from rich.text import Text
 from rich.panel import Panel
 from rich.table import Table
 from rich.status import Status
@@ -14,47 +24,155 @@ from codebase import (
     explore_codebase,
     read_file_content,
     read_file_snippet,
-    scan_file_content
+    task_keywords,
+    walk_codebase
 )
 
+## In the frozen executable, process pool workers re-run this script; freeze_support hands
+## them over to multiprocessing before any of the module-level setup below runs.
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+
+## orjson is several times faster than the stdlib json module; fall back to the stdlib
+## when it is not installed. Both return str and raise json.JSONDecodeError subclasses.
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj, indent: bool = False, sort_keys: bool = False) -> str:
+        option = (orjson.OPT_INDENT_2 if indent else 0) | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(obj, option=option).decode()
+except ImportError:
+    def json_loads(data):
+        return json.loads(data)
+
+    def json_dumps(obj, indent: bool = False, sort_keys: bool = False) -> str:
+        if indent:
+            return json.dumps(obj, indent=2, ensure_ascii=False, sort_keys=sort_keys)
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, sort_keys=sort_keys)
+
 # Initialize rich console
 console = Console()
 
+## Panel styles used by the plan display
+_BLUE_PANEL = partial(Panel, border_style="blue")
+_YELLOW_PANEL = partial(Panel, border_style="yellow")
+_RED_PANEL = partial(Panel, border_style="red")
+
 # Configure logging
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 
-## Add a global executor instance for CPU-bound tasks in the CLI.
-executor = ProcessPoolExecutor(max_workers=4)
+## Process pool for CPU-bound tasks in the CLI, including scanning large files. It is created
+## on first use rather than at import, since spawned workers import this module again.
+_process_executor: Optional[ProcessPoolExecutor] = None
+
+def get_process_executor() -> ProcessPoolExecutor:
+    """Return the shared process pool, creating it on first use."""
+    global _process_executor
+    if _process_executor is None:
+        # Where available, workers are forked from a clean forkserver process rather than
+        # from this one, whose I/O and aiosqlite threads are running by the first scan
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None
+        _process_executor = ProcessPoolExecutor(
+            max_workers=os.cpu_count() or 4,
+            mp_context=multiprocessing.get_context(method)
+        )
+    return _process_executor
+
+## File I/O is offloaded with asyncio.to_thread, so the default executor is sized for
+## I/O fan-out rather than asyncio's min(32, cpu_count + 4). Override with TRAYCER_IO_THREADS.
+DEFAULT_IO_THREADS = 128
+
+def load_env_file(path: str = '.env'):
+    """Load KEY=value lines from a .env file into os.environ without overriding existing variables."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', errors='ignore') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            key = key.strip()
+            if key.startswith('export '):
+                key = key[len('export '):].strip()
+            os.environ.setdefault(key, value.strip().strip('"').strip("'"))
+
+def env_int(name: str, default: int) -> int:
+    """Read a positive integer setting from the environment, warning and using default on a bad value."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        console.print(f"[yellow]Ignoring {name}={value!r}: expected a positive integer, using {default}[/yellow]")
+        return default
+    return number
 
 def get_api_key():
     """Get the Anthropic API key from environment variables or .env file."""
-    try:
-        from dotenv import load_dotenv
-        load_dotenv()  # Load environment variables from .env file
-        
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
-        if not api_key:
-            console.print("[red]Error: ANTHROPIC_API_KEY not found in environment variables or .env file[/red]")
-            console.print("[yellow]Please set your Anthropic API key in a .env file or as an environment variable.[/yellow]")
-            console.print("You can create a .env file with the following content:")
-            console.print("[green]ANTHROPIC_API_KEY=your-api-key-here[/green]")
-            raise ValueError("Missing ANTHROPIC_API_KEY")
-        return api_key
-    except ImportError:
-        console.print("[yellow]python-dotenv not installed. Installing...[/yellow]")
-        import subprocess
-        subprocess.check_call(["pip", "install", "python-dotenv"])
-        from dotenv import load_dotenv
-        load_dotenv()
-        return get_api_key()
+    load_env_file()
+    
+    api_key = os.environ.get("ANTHROPIC_API_KEY")
+    if not api_key:
+        console.print("[red]Error: ANTHROPIC_API_KEY not found in environment variables or .env file[/red]")
+        console.print("[yellow]Please set your Anthropic API key in a .env file or as an environment variable.[/yellow]")
+        console.print("You can create a .env file with the following content:")
+        console.print("[green]ANTHROPIC_API_KEY=your-api-key-here[/green]")
+        raise ValueError("Missing ANTHROPIC_API_KEY")
+    return api_key
 
-try:
-    client = AsyncAnthropic(
-        api_key=get_api_key()
-    )
-except Exception as e:
-    console.print(f"[red]Failed to initialize Anthropic client: {str(e)}[/red]")
-    raise
+## The SDK's pool already keeps far more connections alive than MAX_CONCURRENT_REQUESTS, but
+## drops them after 5s idle; keep them longer so the relevance, follow-up and plan phases
+## reuse the same TLS sessions instead of reconnecting between phases.
+KEEPALIVE_EXPIRY = 60.0
+
+def connection_limits():
+    """The SDK's default connection limits with a longer keepalive expiry."""
+    # Copied rather than rebuilt so the limits class always matches the SDK's HTTP library
+    limits = copy.copy(DEFAULT_CONNECTION_LIMITS)
+    limits.keepalive_expiry = KEEPALIVE_EXPIRY
+    return limits
+
+## HTTP/2 multiplexes the concurrent relevance batches over one TLS connection instead of
+## one handshake per request; it needs the optional h2 package, so fall back to HTTP/1.1 without it.
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+## The client is created on first use rather than at import, so process pool workers that
+## import this module again neither read the API key nor open an HTTP client.
+_client: Optional[AsyncAnthropic] = None
+
+def get_client() -> AsyncAnthropic:
+    """Return the shared Anthropic client, creating it on first use."""
+    global _client
+    if _client is None:
+        try:
+            _client = AsyncAnthropic(
+                api_key=get_api_key(),
+                http_client=DefaultAsyncHttpxClient(limits=connection_limits(), http2=HTTP2_AVAILABLE)
+            )
+        except Exception as e:
+            console.print(f"[red]Failed to initialize Anthropic client: {str(e)}[/red]")
+            raise
+    return _client
+
+## Relevance batches and their follow-ups are issued concurrently; cap the requests in
+## flight so a large codebase does not trip the API rate limits. Override with ANTHROPIC_CONCURRENCY.
+## The cap is read on first use, once main() has loaded .env.
+MAX_CONCURRENT_REQUESTS = 10
+_request_semaphore: Optional[asyncio.Semaphore] = None
+
+def get_request_semaphore() -> asyncio.Semaphore:
+    """Return the semaphore capping the API requests in flight, creating it on first use."""
+    global _request_semaphore
+    if _request_semaphore is None:
+        _request_semaphore = asyncio.Semaphore(env_int("ANTHROPIC_CONCURRENCY", MAX_CONCURRENT_REQUESTS))
+    return _request_semaphore
 
 ## Global variables to accumulate token usage from Anthropic API calls
 total_prompt_tokens = 0
@@ -68,13 +186,12 @@ def print_anthropic_cost():
     console.print(f"[bold cyan]Output tokens: {total_completion_tokens}[/bold cyan]")
     console.print(f"[bold cyan]Total cost: ${total_cost:.6f}[/bold cyan]")
 
-async def anthropic_message_create(*args, **kwargs):
+def record_usage(response):
     """
-    Wrapper for client.messages.create that accumulates the token usage.
+    Accumulate the token usage of a response into the session totals.
     Assumes the response has a 'usage' or 'meta' attribute that contains 'total_tokens'.
     """
     global total_prompt_tokens, total_completion_tokens
-    response = await client.messages.create(*args, **kwargs)
     #print("Response: ", response)
     try:
         usage = getattr(response, "usage", None)
@@ -99,6 +216,84 @@ async def anthropic_message_create(*args, **kwargs):
                 #print("Total completion tokens (dict): ", total_completion_tokens)
     except Exception as e:
         logging.error(f"Error retrieving token usage: {e}")
+
+## Responses are memoized in the persistent cache, keyed by a hash of the full request, so
+## re-running the same task over unchanged files costs no API calls. Disable with --no-cache.
+response_cache_enabled = True
+
+## Only complete responses are memoized; one cut off at max_tokens would otherwise be replayed
+## on every later run instead of retrying the request.
+CACHEABLE_STOP_REASONS = frozenset({"end_turn", "tool_use"})
+
+def response_cache_key(request: dict) -> str:
+    """Build the persistent cache key for an API request from a hash of its canonical JSON."""
+    digest = hashlib.blake2b(json_dumps(request, sort_keys=True).encode(), digest_size=32)
+    return f"anthropic:{digest.hexdigest()}"
+
+def is_cacheable_response(response: Message, cacheable=None) -> bool:
+    """Whether a response is complete and, if a cacheable check is given, passes it."""
+    return response.stop_reason in CACHEABLE_STOP_REASONS and (cacheable is None or cacheable(response))
+
+async def get_cached_response(request: dict, cacheable=None) -> Optional[Message]:
+    """
+    Return the memoized response for a request, or None on a miss or when caching is disabled.
+    Entries that would no longer be stored (see store_cached_response) count as misses.
+    """
+    if not response_cache_enabled:
+        return None
+    from persistent_cache import get_cache
+    cached = await get_cache(response_cache_key(request))
+    if not cached:
+        return None
+    response = Message.model_validate(cached)
+    if not is_cacheable_response(response, cacheable):
+        return None
+    print("[INFO] API response read from persistent cache (no tokens used)")
+    return response
+
+async def store_cached_response(request: dict, response: Message, cacheable=None):
+    """
+    Memoize a response for later runs. Truncated responses are not stored, nor ones that
+    fail the caller's cacheable check.
+    """
+    if response_cache_enabled and is_cacheable_response(response, cacheable):
+        from persistent_cache import set_cache
+        await set_cache(response_cache_key(request), response.model_dump(mode="json"))
+
+async def anthropic_message_create(cacheable=None, **kwargs):
+    """
+    Wrapper for client.messages.create that accumulates the token usage.
+    At most MAX_CONCURRENT_REQUESTS (or ANTHROPIC_CONCURRENCY) calls are in flight at once. Cached responses
+    are returned without a request and add no usage; cacheable, if given, is called with
+    a response to decide whether it may be memoized.
+    """
+    response = await get_cached_response(kwargs, cacheable)
+    if response is not None:
+        return response
+    async with get_request_semaphore():
+        response = await get_client().messages.create(**kwargs)
+    record_usage(response)
+    await store_cached_response(kwargs, response, cacheable)
+    return response
+
+async def anthropic_message_stream(on_tool_input=None, cacheable=None, **kwargs):
+    """
+    Streaming counterpart of anthropic_message_create. While the response streams in,
+    on_tool_input is called with each partial snapshot of the tool input so callers can
+    act on completed parts before the whole response has arrived.
+    Returns the final message once the stream ends, or the cached response without streaming.
+    """
+    response = await get_cached_response(kwargs, cacheable)
+    if response is not None:
+        return response
+    async with get_request_semaphore():
+        async with get_client().messages.stream(**kwargs) as stream:
+            async for event in stream:
+                if on_tool_input is not None and event.type == "input_json":
+                    on_tool_input(event.snapshot)
+            response = await stream.get_final_message()
+    record_usage(response)
+    await store_cached_response(kwargs, response, cacheable)
     return response
 
 def count_calls(func):
@@ -109,214 +304,352 @@ def count_calls(func):
     wrapper.calls = 0
     return wrapper
 
-import aiofiles
+## Prompt payloads are serialized compactly: indentation only adds billed input tokens.
+SNIPPET_CONTEXT_LIMIT = 400  # Characters of context kept per snippet in prompts
 
-async def process_file(file_path, code_extensions, text_extensions, keywords, semaphore, is_target_file=False):
+def to_prompt_json(data) -> str:
+    """Serialize data for a prompt: no indentation or ASCII escaping."""
+    return json_dumps(data)
+
+def truncate_snippets(snippets: list) -> list:
+    """Cap each snippet's context at SNIPPET_CONTEXT_LIMIT characters before it goes into a prompt."""
+    return [
+        {**snippet, 'context': snippet.get('context', '')[:SNIPPET_CONTEXT_LIMIT]}
+        for snippet in snippets
+    ]
+
+## Relevance checks send as many files per call as fit comfortably in the context window.
+RELEVANCE_BATCH_SIZE = 50
+RELEVANCE_BATCH_TOKEN_BUDGET = 150_000  # Stay well below the 200k-token context window
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token) used to size request batches."""
+    return len(text) // 4
+
+def split_relevance_batches(batch_data: list) -> list:
     """
-    Process a single file by gathering metadata and scanning for relevant content.
-    Implements early filtering for binary and large files.
+    Split file entries into batches capped by RELEVANCE_BATCH_SIZE and by the
+    estimated token budget, so a handful of huge files cannot overflow one request.
     """
-    async with semaphore:
-        try:
-            file_size = await asyncio.to_thread(os.path.getsize, file_path)
-            file_extension = os.path.splitext(file_path)[1].lower()
-            last_modified = await asyncio.to_thread(os.path.getmtime, file_path)
-            
-            # Early filtering for large files (>10MB) or binary content
-            MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
-            # TODO: figure out some way to shrink large files so they can be sent as context to the ai model
-            if file_size > MAX_FILE_SIZE:
-                return {
-                    'path': file_path,
-                    'size': file_size,
-                    'extension': file_extension,
-                    'importance': 'high' if is_target_file else 'low',
-                    'last_modified': last_modified,
-                    'snippets': [],
-                    'skip_reason': 'File too large'
+    batches = []
+    current = []
+    current_tokens = 0
+    for entry in batch_data:
+        entry_tokens = estimate_tokens(to_prompt_json(entry))
+        if current and (len(current) >= RELEVANCE_BATCH_SIZE or
+                        current_tokens + entry_tokens > RELEVANCE_BATCH_TOKEN_BUDGET):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(entry)
+        current_tokens += entry_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def task_system_prompt(task_description: str) -> list:
+    """
+    Build the system block carrying the task description. The block is identical on every
+    call, but the cached prefix is tools, then system, then messages, so it is only shared
+    by calls that send the same tools. A task description alone is far below the minimum
+    cacheable prefix; in practice the reuse is among the relevance batches, whose prefix
+    runs on to the breakpoint on RELEVANCE_INSTRUCTIONS.
+    """
+    return [{
+        "type": "text",
+        "text": f"Task: {task_description}",
+        "cache_control": {"type": "ephemeral"}
+    }]
+
+## Structured output: each call forces a tool whose input_schema describes the expected JSON,
+## so responses arrive as already-parsed ToolUseBlock.input dicts instead of free text.
+RELEVANCE_TOOL = {
+    "name": "report_relevance",
+    "description": "Report how relevant each analyzed file is to the task.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "files": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "path": {"type": "string", "description": "File path"},
+                        "relevance": {"type": "string", "enum": ["high", "medium", "low"]},
+                        "needs_more_context": {
+                            "type": "string",
+                            "description": "Line numbers or areas you'd like to see, if more context is needed"
+                        }
+                    },
+                    "required": ["path", "relevance"]
                 }
-            
-            # Check for binary content (read first 8KB)
-            async with aiofiles.open(file_path, 'rb') as f:
-                sample = await f.read(8192)
-                try:
-                    sample.decode('utf-8')
-                except UnicodeDecodeError:
-                    return {
-                        'path': file_path,
-                        'size': file_size,
-                        'extension': file_extension,
-                        'importance': 'high' if is_target_file else 'low',
-                        'last_modified': last_modified,
-                        'snippets': [],
-                        'skip_reason': 'Binary file'
+            }
+        },
+        "required": ["files"]
+    }
+}
+
+PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "explanation": {"type": "string"},
+        "files_modified": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "path": {"type": "string"},
+                    "changes": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "line_range": {"type": "string"},
+                                "action": {"type": "string"},
+                                "description": {"type": "string"},
+                                "code": {"type": "string"}
+                            },
+                            "required": ["line_range", "action", "description"]
+                        }
                     }
-            
-            # Determine importance based on file type and target status
-            if is_target_file:
-                importance = 'high'
-            elif file_extension in code_extensions:
-                importance = 'medium'
-            elif file_extension in text_extensions:
-                importance = 'low'
-            else:
-                importance = 'low'
-            
-            # Only scan content for potentially relevant files
-            snippets = []
-            if importance != 'low':
-                snippets = await scan_file_content(file_path, keywords)
-            
-            return {
-                'path': file_path,
-                'size': file_size,
-                'extension': file_extension,
-                'importance': importance,
-                'last_modified': last_modified,
-                'snippets': snippets
+                },
+                "required": ["path", "changes"]
             }
-        except Exception as e:
-            logging.error(f"Error processing file {file_path}: {str(e)}")
-            return {'path': file_path, 'error': str(e)}
+        },
+        "codebase_analysis": {
+            "type": "object",
+            "properties": {
+                "current_state": {"type": "string"},
+                "recommendations": {"type": "array", "items": {"type": "string"}}
+            },
+            "required": ["current_state", "recommendations"]
+        }
+    },
+    "required": ["explanation", "files_modified", "codebase_analysis"],
+    "additionalProperties": False
+}
 
-async def scan_file_content(file_path, keywords):
+PLAN_TOOL = {
+    "name": "submit_task_plan",
+    "description": "Submit the task plan for the codebase.",
+    "input_schema": PLAN_SCHEMA
+}
+
+_json_decoder = json.JSONDecoder()
+
+def extract_json(text: str):
     """
-    Quickly scan a file for relevant keywords using chunked reading to reduce memory usage.
-    Returns a list of dictionaries containing:
-    - line_range: string showing the range of lines included in the snippet (e.g. "205 - 209")
-    - context: the actual text content from those lines
-    
-    Each match includes 2 lines before and 2 lines after for context. All matches in the file
-    are returned, with no limit on the number of snippets.
+    Parse the first JSON object embedded in free text, or return None. raw_decode parses from each '{' and
+    stops where the object ends, so trailing prose after it does not break parsing.
     """
-    snippets = []
-    line_buffer = []  # Buffer to store context lines
-    current_line = 0
-    chunk_size = 8192  # 8KB chunks
-    
-    try:
-        async with aiofiles.open(file_path, 'r', encoding='utf-8', errors='replace') as f:
-            # Read file in chunks to reduce memory usage
-            while True:
-                chunk = await f.read(chunk_size)
-                if not chunk:
-                    break
-                    
-                lines = chunk.split('\n')
-                # Handle line spanning across chunks
-                if line_buffer and lines:
-                    line_buffer[-1] += lines[0]
-                    lines = lines[1:]
-                
-                line_buffer.extend(lines)
-                
-                # Process complete lines, keeping a few lines as buffer for context
-                while len(line_buffer) > 4:  # Keep 4 lines for context
-                    line = line_buffer[0]
-                    if any(keyword.lower() in line.lower() for keyword in keywords):
-                        # Get context (2 lines before and 2 after)
-                        context_start = max(0, len(line_buffer) - 5)
-                        context = '\n'.join(line_buffer[context_start:len(line_buffer)])
-                        snippets.append({
-                            'line_range': f"{current_line - 2} - {current_line + 2}",
-                            'context': context
-                        })
-                    line_buffer.pop(0)
-                    current_line += 1
-            # Process any remaining lines in the buffer
-            for idx, line in enumerate(line_buffer):
-                if any(keyword.lower() in line.lower() for keyword in keywords):
-                    start = max(0, idx - 2)
-                    end = min(len(line_buffer), idx + 3)
-                    context = '\n'.join(line_buffer[start:end])
-                    start_line = current_line + start + 1  # converting to 1-based numbering
-                    end_line = current_line + end
-                    snippets.append({
-                        'line_range': f"{start_line} - {end_line}",
-                        'context': context
-                    })
-                    
-        return snippets
-    except Exception as e:
-        logging.error(f"Error scanning file {file_path}: {str(e)}")
-        return []
+    start = text.find('{')
+    while start != -1:
+        try:
+            obj, _ = _json_decoder.raw_decode(text, start)
+            if isinstance(obj, dict):
+                return obj
+        except json.JSONDecodeError:
+            pass
+        start = text.find('{', start + 1)
+    return None
 
-async def batch_relevance_check(files, task_description):
+def find_tool_input(response, tool_name: str):
+    """Return the input of the named tool call in a response, or None if the model did not call it."""
+    for block in response.content or []:
+        if isinstance(block, ToolUseBlock) and block.name == tool_name:
+            return block.input
+    return None
+
+## Lines from the top of each file sent alongside its snippets (imports, module docstring)
+FILE_HEAD_LINES = 40
+FILE_HEAD_CHARS = 2048  # Cap on each head, since minified files can put everything on one line
+
+def to_columnar_files(batch_data: list) -> dict:
     """
-    Check relevance of multiple files in a single AI call to reduce API usage.
+    Convert a list of per-file dicts into parallel arrays for the prompt, so key names
+    are sent once per batch instead of once per file and once per snippet.
     """
-    if not files:
-        return []
-    
-    file_summaries = []
-    for i in range(0, len(files), 5):  # Process in batches of 5
-        batch = files[i:i+5]
-        # Add full file content as a separate step to avoid f-string issues
-        batch_data = []
-        for f in batch:
-            full_content = await read_file_content(f['path'])
-            batch_data.append({
-                'path': f['path'],
-                'snippets': f['snippets'],
-                'full_content': full_content
-            })
-            
-        message = {
-            "role": "user",
-            "content": f"""Task: {task_description}
-
-Files to analyze:
-{json.dumps(batch_data, indent=2)}
-
-For each file, respond with a JSON array of objects containing:
+    return {
+        "paths": [f['path'] for f in batch_data],
+        "snippets": [[[s['line_range'], s['context']] for s in f['snippets']] for f in batch_data],
+        "heads": [f['head'] for f in batch_data]
+    }
+
+RELEVANCE_INSTRUCTIONS = f"""The files are given as parallel arrays: file i has path paths[i], keyword snippets
+snippets[i] (a list of [line_range, context] pairs) and its first {FILE_HEAD_LINES} lines heads[i],
+cut to at most {FILE_HEAD_CHARS} characters.
+Request any other part of a file with needs_more_context rather than guessing.
+
+Rate every file with the report_relevance tool:
 - path: file path
 - relevance: "high", "medium", or "low"
 - needs_more_context: (optional) if you need more context, specify the line numbers or areas you'd like to see
 """
-        }
-        
-        response = await anthropic_message_create(
+
+def default_relevance(batch_data: list, relevance: str = 'medium') -> list:
+    """Rate every file in a batch the same without asking the API."""
+    return [{'path': f['path'], 'relevance': relevance} for f in batch_data]
+
+async def check_relevance_batch(batch_data: list, task_description: str) -> list:
+    """
+    Rate the relevance of one batch of files with a single API call.
+    The task and the instructions are identical across batches and are marked for prompt
+    caching, so only the file list is billed at the full input rate.
+    """
+    # Serialize the file list off the event loop so concurrent batches keep their responses flowing
+    files_json = await asyncio.to_thread(lambda: to_prompt_json(to_columnar_files(batch_data)))
+    message = {
+        "role": "user",
+        "content": [
+            {
+                "type": "text",
+                "text": RELEVANCE_INSTRUCTIONS,
+                "cache_control": {"type": "ephemeral"}
+            },
+            {
+                "type": "text",
+                "text": f"Files to analyze:\n{files_json}"
+            }
+        ]
+    }
+    
+    # Follow-up context requests are started as soon as their file's entry has fully
+    # streamed in, overlapping them with the rest of the batch response
+    follow_ups = {}
+    
+    def start_follow_up(item):
+        if item.get('needs_more_context') and item.get('path') and item['path'] not in follow_ups:
+            follow_ups[item['path']] = asyncio.create_task(
+                relevance_after_context(item['path'], item['needs_more_context'], task_description)
+            )
+    
+    def on_tool_input(snapshot):
+        files = snapshot.get("files") if isinstance(snapshot, dict) else None
+        if isinstance(files, list):
+            # Every entry but the last is complete; the last may still be streaming
+            for item in files[:-1]:
+                if isinstance(item, dict):
+                    start_follow_up(item)
+    
+    try:
+        response = await anthropic_message_stream(
+            on_tool_input=on_tool_input,
             max_tokens=4096,  # Increased token limit for larger responses
+            system=task_system_prompt(task_description),
             messages=[message],
+            tools=[RELEVANCE_TOOL],
+            tool_choice={"type": "tool", "name": RELEVANCE_TOOL["name"]},
             model="claude-3-5-sonnet-latest"
         )
         
-        # Handle different response content types
-        try:
-            if isinstance(response.content, TextBlock):
-                content_str = str(response.content[0].text)
-                print(f"Received response: {content_str}")
-                json_start = content_str.find('[')
-                json_end = content_str.rfind(']') + 1
-                if json_start != -1 and json_end != -1:
-                    json_str = content_str[json_start:json_end]
-                    parsed_content = json.loads(json_str)
-                    
-                    # Handle requests for more context
-                    for item in parsed_content:
-                        if item.get('needs_more_context'):
-                            additional_context = await get_additional_context(
-                                item['path'], 
-                                item['needs_more_context']
-                            )
-                            # Make another API call with additional context
-                            item['relevance'] = await get_relevance_with_context(
-                                item['path'],
-                                additional_context,
-                                task_description
-                            )
-                    
-                    file_summaries.extend(parsed_content)
-                else:
-                    file_summaries.extend([{'path': f['path'], 'relevance': 'medium'} for f in batch])
-            else:
-                file_summaries.extend([{'path': f['path'], 'relevance': 'medium'} for f in batch])
-        except Exception as e:
-            logging.error(f"Error processing response: {str(e)}")
-            console.print(f"[red]Error processing response: {str(e)}[/red]")
-            file_summaries.extend([{'path': f['path'], 'relevance': 'medium'} for f in batch])
+        tool_input = find_tool_input(response, RELEVANCE_TOOL["name"])
+        if tool_input is None:
+            raise ValueError(f"Response did not call the {RELEVANCE_TOOL['name']} tool")
+        parsed_content = tool_input.get("files", [])
+        print(f"Received response: {json_dumps(parsed_content)}")
+        
+        # Handle requests for more context, including any the stream had not yet completed
+        for item in parsed_content:
+            start_follow_up(item)
+        for item in parsed_content:
+            if item.get('path') in follow_ups:
+                item['relevance'] = await follow_ups[item['path']]
+        
+        return parsed_content
+    except Exception as e:
+        # Every failure, including a response without the tool call, rates the batch medium
+        logging.error(f"Error processing response: {str(e)}")
+        console.print(f"[red]Error processing response: {str(e)}[/red]")
+        return default_relevance(batch_data)
+    finally:
+        # Do not leave follow-ups running if the batch failed or was cancelled
+        for task in follow_ups.values():
+            task.cancel()
+
+async def relevance_after_context(file_path: str, context_request: str, task_description: str) -> str:
+    """
+    Fetch the extra context the model asked for and re-rate the file's relevance with it.
+    """
+    additional_context = await get_additional_context(file_path, context_request)
+    # Make another API call with additional context
+    return await get_relevance_with_context(file_path, additional_context, task_description)
+
+## Past this many candidates only the best lexical matches are sent to the API and the
+## rest are rated low locally, so API usage stays bounded however large the codebase is.
+RELEVANCE_API_MAX_FILES = 100
+
+def lexical_scores(files: list, keywords: frozenset) -> list:
+    """
+    Score each file's path and snippets against the task keywords with TF-IDF: keywords that
+    match in few files weigh more, and repeated hits count logarithmically.
+    """
+    counts = []
+    for f in files:
+        text = '\n'.join([f['path'], *(s.get('context', '') for s in f.get('snippets', []))]).lower()
+        counts.append({keyword: text.count(keyword) for keyword in keywords})
+    total = len(files)
+    document_frequency = {keyword: sum(1 for c in counts if c[keyword]) for keyword in keywords}
+    return [
+        sum(
+            (1 + math.log(c[keyword])) * math.log(1 + total / document_frequency[keyword])
+            for keyword in keywords if c[keyword]
+        )
+        for c in counts
+    ]
+
+def select_for_api(files: list, keywords: frozenset, limit: int = RELEVANCE_API_MAX_FILES):
+    """
+    Keep target files and the best-scoring others, up to limit files in all, for the API.
+    Returns (kept, locally_rated), the latter already rated low.
+    """
+    targets = [f for f in files if f.get('importance') == 'high']
+    others = [f for f in files if f.get('importance') != 'high']
+    ranked = [f for _, f in sorted(
+        zip(lexical_scores(others, keywords), others), key=lambda pair: pair[0], reverse=True
+    )]
+    room = max(limit - len(targets), 0)
+    return targets + ranked[:room], default_relevance(ranked[room:], 'low')
+
+async def batch_relevance_check(files, task_description):
+    """
+    Check relevance of many files per AI call to reduce API usage.
+    Files are packed into as few batches as the token budget allows and the
+    batches are sent concurrently rather than one after another.
+    """
+    # Files without a single keyword hit are rated low without a read or an API call;
+    # target files named in the task are still sent, since they have no snippets to go on
+    skipped = default_relevance(
+        [f for f in files if not f.get('snippets') and f.get('importance') != 'high'], 'low'
+    )
+    files = [f for f in files if f.get('snippets') or f.get('importance') == 'high']
+    if len(files) > RELEVANCE_API_MAX_FILES:
+        files, locally_rated = await asyncio.to_thread(select_for_api, files, task_keywords(task_description))
+        skipped += locally_rated
+    if not files:
+        return skipped
     
-    return file_summaries
+    # Each file is sent as its snippets plus the head of the file rather than its full content;
+    # the model asks for anything else through needs_more_context. The reads run concurrently
+    heads = await asyncio.gather(*(read_file_snippet(f['path'], 0, FILE_HEAD_LINES) for f in files))
+    batch_data = [
+        {
+            'path': f['path'],
+            'snippets': truncate_snippets(f['snippets']),
+            'head': head[:FILE_HEAD_CHARS]
+        }
+        for f, head in zip(files, heads)
+    ]
+    
+    # Sizing the batches serializes every entry, so it runs off the event loop
+    batches = await asyncio.to_thread(split_relevance_batches, batch_data)
+    results = await asyncio.gather(*(
+        check_relevance_batch(batch, task_description)
+        for batch in batches
+    ))
+    return skipped + [item for batch_result in results for item in batch_result]
+
+## Line ranges in a needs_more_context request, e.g. "lines 10-20" or "line 5"
+_LINES_RE = re.compile(r'lines?\s*(\d+)(?:\s*-\s*(\d+))?', re.IGNORECASE)
 
 async def get_additional_context(file_path: str, context_request: str) -> dict:
     """
@@ -331,11 +664,11 @@ async def get_additional_context(file_path: str, context_request: str) -> dict:
     """
     try:
         if 'lines' in context_request.lower():
-            # Extract line numbers from request
-            matches = re.findall(r'lines?\s*(\d+)(?:\s*-\s*(\d+))?', context_request.lower())
-            if matches:
-                start = int(matches[0][0])
-                end = int(matches[0][1]) if matches[0][1] else start + 20
+            # Extract the first line range from the request
+            match = _LINES_RE.search(context_request)
+            if match:
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else start + 20
                 content = await read_file_snippet(file_path, start - 1, end - start + 1)
                 return {
                     'type': 'lines',
@@ -362,10 +695,8 @@ async def get_relevance_with_context(file_path: str, context: dict, task_descrip
     """
     message = {
         "role": "user",
-        "content": f"""Task: {task_description}
-
-Additional context requested for {file_path}:
-{json.dumps(context, indent=2)}
+        "content": f"""Additional context requested for {file_path}:
+{to_prompt_json(context)}
 
 Please analyze this additional context and provide a final relevance rating ("high", "medium", or "low").
 """
@@ -374,6 +705,7 @@ Please analyze this additional context and provide a final relevance rating ("hi
     try:
         response = await anthropic_message_create(
             max_tokens=1024,
+            system=task_system_prompt(task_description),
             messages=[message],
             model="claude-3-5-sonnet-latest"
         )
@@ -389,38 +721,80 @@ Please analyze this additional context and provide a final relevance rating ("hi
         logging.error(f"Error getting relevance with context: {str(e)}")
         return 'medium'
 
+## For small codebases the plan call is issued speculatively on every file while the
+## relevance check runs, overlapping the two round-trips; larger ones are pruned first.
+SPECULATIVE_PLAN_MAX_FILES = 50
+
 async def generate_task_plan(task_description, codebase_summary):
     """
     Generate a focused task plan based on relevant files and their contents.
     """
-    relevance_results = await batch_relevance_check(codebase_summary, task_description)
+    relevance_task = asyncio.create_task(batch_relevance_check(codebase_summary, task_description))
+    speculative_task = None
+    if len(codebase_summary) <= SPECULATIVE_PLAN_MAX_FILES:
+        speculative_task = asyncio.create_task(request_task_plan(task_description, [
+            {'path': file['path'], 'snippets': truncate_snippets(file['snippets'])}
+            for file in codebase_summary
+        ]))
+        await asyncio.wait({relevance_task, speculative_task}, return_when=asyncio.FIRST_COMPLETED)
+        if not relevance_task.done() and speculative_task.exception() is None:
+            # The speculative plan landed first, so pruning can no longer save anything
+            relevance_task.cancel()
+            return speculative_task.result()
+    
+    relevance_results = await relevance_task
     print(f"Received relevance results for {len(relevance_results)} files.")
-    print("Results:", json.dumps(relevance_results, indent=2))
+    print("Results:", json_dumps(relevance_results, indent=True))
     
-    # Filter for high relevance files
-    filtered_results = [r for r in relevance_results if isinstance(r, dict) and r.get('relevance') == 'high']
+    relevance_by_path = {
+        r['path']: r.get('relevance', 'low')
+        for r in relevance_results if isinstance(r, dict) and 'path' in r
+    }
     
-    # Combine file information with relevance results
-    enhanced_summary = []
-    for file in codebase_summary:
-        relevance = next((r['relevance'] for r in filtered_results if r['path'] == file['path']), 'low')
-        summary = {
+    # Only high relevance files go into the plan prompt; fall back to medium ones if none rated high
+    selected_relevance = 'high' if 'high' in relevance_by_path.values() else 'medium'
+    enhanced_summary = [
+        {
             'path': file['path'],
-            'importance': file['importance'],
-            'relevance': relevance,
-            'snippets': file['snippets']
+            'relevance': selected_relevance,
+            'snippets': truncate_snippets(file['snippets'])
         }
-        enhanced_summary.append(summary)
+        for file in codebase_summary
+        if relevance_by_path.get(file['path'], 'low') == selected_relevance
+    ]
     
+    if speculative_task is not None:
+        if len(enhanced_summary) == len(codebase_summary):
+            # Pruning removed nothing, so the speculative plan covers exactly the same files;
+            # if it failed (e.g. rate limited), the real request below retries it
+            try:
+                return await speculative_task
+            except Exception as e:
+                logging.error(f"Speculative task plan request failed: {str(e)}")
+        else:
+            discard_task(speculative_task)
+    return await request_task_plan(task_description, enhanced_summary)
+
+def discard_task(task: asyncio.Task):
+    """Cancel a pending task, or retrieve a finished one's exception so asyncio does not log it as never retrieved."""
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        task.exception()
+
+async def request_task_plan(task_description, enhanced_summary):
+    """
+    Ask the model for the task plan over the given file summaries.
+    Returns the plan as a dict, or the raw response text if it held no JSON object.
+    """
+    summary_json = await asyncio.to_thread(to_prompt_json, enhanced_summary)
     # Updated message to the AI to require detailed change descriptions (at least 2 sentences)
     message = {
         "role": "user",
-        "content": f"""Task: {task_description}
-
-Relevant Files Analysis:
-{json.dumps(enhanced_summary, indent=2)}
+        "content": f"""Relevant Files Analysis:
+{summary_json}
 
-Please provide a JSON object that strictly adheres to the following format. The JSON must have exactly three top-level keys: 'explanation', 'files_modified', and 'codebase_analysis'.
+Submit the plan with the submit_task_plan tool. Its input must have exactly three top-level keys: 'explanation', 'files_modified', and 'codebase_analysis'.
 
 - 'explanation' should be a string that briefly describes the task and approach.
 - 'files_modified' must be an array where each element is an object with the following keys:
@@ -434,40 +808,45 @@ Please provide a JSON object that strictly adheres to the following format. The
     - 'current_state': a string describing the current implementation
     - 'recommendations': an array of specific recommendations for improvement
 
-No additional keys are allowed in the JSON response. The response must be valid JSON."""
+No additional keys are allowed in the tool input."""
     }
     
-    response = await anthropic_message_create(
+    # Streamed so the SDK assembles the tool input as it arrives, overlapping the parse with the
+    # network; with the tool forced, the message ends as soon as the plan object is complete
+    response = await anthropic_message_stream(
         max_tokens=1024,
+        system=task_system_prompt(task_description),
         messages=[message],
-        model="claude-3-5-sonnet-latest"
+        tools=[PLAN_TOOL],
+        tool_choice={"type": "tool", "name": PLAN_TOOL["name"]},
+        model="claude-3-5-sonnet-latest",
+        cacheable=is_valid_plan_response
     )
     # Parse the response content
     try:
-        content_str = str(response.content[0].text) if isinstance(response.content, TextBlock) else response.content[0].text
+        tool_input = find_tool_input(response, PLAN_TOOL["name"])
+        if tool_input is not None:
+            return tool_input
         
-        # Try to find JSON object in the response
-        json_start = content_str.find('{')
-        json_end = content_str.rfind('}') + 1
+        # The model did not call the tool; fall back to extracting JSON from its text
+        content_str = next((block.text for block in response.content if isinstance(block, TextBlock)), "")
         
-        if json_start != -1 and json_end != -1:
-            json_str = content_str[json_start:json_end]
-            try:
-                parsed_content = json.loads(json_str)
-                return json.dumps(parsed_content, indent=2)
-            except json.JSONDecodeError:
-                print("Warning: Failed to parse JSON from response")
+        # Try to find JSON object in the response
+        parsed_content = extract_json(content_str)
+        if parsed_content is not None:
+            return parsed_content
+        print("Warning: Failed to parse JSON from response")
         
         # If no valid JSON found, return the raw content for validation
         return content_str
     except Exception as e:
         print(f"Error processing response: {str(e)}")
         # Return a basic error response in the expected format
-        return json.dumps({
+        return {
             "explanation": "Error processing AI response",
             "files_modified": [],
             "codebase_analysis": f"Unable to analyze due to error: {str(e)}"
-        }, indent=2)
+        }
 
 @count_calls
 def transform_plan_format(plan_obj: dict) -> dict:
@@ -486,7 +865,7 @@ def transform_plan_format(plan_obj: dict) -> dict:
     new_plan = {
         "explanation": "The plan outlines optimizations based on current analysis.",
         "files_modified": [],
-        "codebase_analysis": json.dumps(plan_obj, indent=2)
+        "codebase_analysis": json_dumps(plan_obj, indent=True)
     }
     return new_plan
 
@@ -496,193 +875,90 @@ async def async_transform_plan_format(plan_obj: dict) -> dict:
     This uses the ProcessPoolExecutor to avoid blocking the event loop.
     """
     loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(executor, transform_plan_format, plan_obj)
+    return await loop.run_in_executor(get_process_executor(), transform_plan_format, plan_obj)
 
-def validate_json_schema(data: dict) -> bool:
-    """Validate that the JSON data follows the required schema."""
-    required_schema = {
-        "explanation": {
-            "type": str,
-            "required": True
-        },
+## Local plan validation. This deliberately mirrors the historical checks rather than
+## PLAN_SCHEMA: extra keys are tolerated and recommendations may be a single string.
+PLAN_VALIDATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "explanation": {"type": "string"},
         "files_modified": {
-            "type": list,
-            "required": True,
+            "type": "array",
             "items": {
-                "type": dict,
-                "required_keys": ["path", "changes"],
-                "changes_schema": {
-                    "type": list,
-                    "items": {
-                        "type": dict,
-                        "required_keys": ["line_range", "action", "description"]
+                "type": "object",
+                "properties": {
+                    "changes": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "required": ["line_range", "action", "description"]
+                        }
                     }
-                }
+                },
+                "required": ["path", "changes"]
             }
         },
         "codebase_analysis": {
-            "type": dict,
-            "required": True,
-            "required_keys": ["current_state", "recommendations"]
+            "type": "object",
+            "properties": {
+                "recommendations": {"type": ["array", "string"]}
+            },
+            "required": ["current_state", "recommendations"]
         }
-    }
-    
-    # Validate top-level structure
-    for key, schema in required_schema.items():
-        if schema["required"] and key not in data:
-            return False
-            
-        if key in data:
-            value = data[key]
-            if not isinstance(value, schema["type"]):
-                return False
-                
-            # Validate files_modified array
-            if key == "files_modified":
-                for file_mod in value:
-                    if not isinstance(file_mod, dict):
-                        return False
-                    if not all(k in file_mod for k in schema["items"]["required_keys"]):
-                        return False
-                    # Validate changes array
-                    changes = file_mod.get("changes", [])
-                    if not isinstance(changes, list):
-                        return False
-                    for change in changes:
-                        if not isinstance(change, dict):
-                            return False
-                        if not all(k in change for k in schema["items"]["changes_schema"]["items"]["required_keys"]):
-                            return False
-                            
-            # Validate codebase_analysis structure
-            elif key == "codebase_analysis":
-                if not all(k in value for k in schema["required_keys"]):
-                    return False
-                if not isinstance(value["recommendations"], (list, str)):
-                    return False
-    
-    return True
+    },
+    "required": ["explanation", "files_modified", "codebase_analysis"]
+}
+## Compiled once at import into a straight-line validator function
+_validate_plan = fastjsonschema.compile(PLAN_VALIDATION_SCHEMA)
 
-async def validate_ai_response(response: str):
-    """Validate and format AI response with retry logic."""
-    MAX_ATTEMPTS = 3
-    attempts = 0
-    
-    while attempts < MAX_ATTEMPTS:
-        try:
-            response_json = json.loads(response)
-            
-            # Check if response has the required structure
-            if validate_json_schema(response_json):
-                return json.dumps(response_json, indent=2)
-            
-            # If schema validation fails, try to fix the response
-            logging.info(f"Attempt {attempts + 1}: JSON schema validation failed, requesting correction")
-            response = await fix_json_plan(response, "Response does not match required schema")
-            if not response:
-                break
-                
-            attempts += 1
-            
-        except json.JSONDecodeError as e:
-            logging.error(f"Attempt {attempts + 1}: JSON parsing failed: {str(e)}")
-            response = await fix_json_plan(response, str(e))
-            if not response:
-                break
-                
-            attempts += 1
-            
-        except Exception as e:
-            logging.error(f"Unexpected error during validation: {str(e)}")
-            break
-    
-    # Return fallback response if all attempts fail
-    return json.dumps({
-        "explanation": "Error processing AI response after multiple attempts",
+def validate_json_schema(data: dict) -> bool:
+    """Validate that the JSON data follows the required schema."""
+    try:
+        _validate_plan(data)
+        return True
+    except fastjsonschema.JsonSchemaException:
+        return False
+
+def is_valid_plan_response(response) -> bool:
+    """Whether a plan response carries a submit_task_plan input that passes local validation."""
+    tool_input = find_tool_input(response, PLAN_TOOL["name"])
+    return isinstance(tool_input, dict) and validate_json_schema(tool_input)
+
+def fallback_plan(raw_response: str) -> dict:
+    """Build a schema-conforming plan that carries the raw AI output when it could not be used."""
+    return {
+        "explanation": "The AI response did not match the expected plan format",
         "files_modified": [],
         "codebase_analysis": {
-            "current_state": "Error state",
-            "recommendations": [f"Failed to process response after {attempts} attempts"]
+            "current_state": raw_response,
+            "recommendations": []
         }
-    }, indent=2)
+    }
 
-async def fix_json_plan(raw_plan: str, error_details: str = None) -> str:
+async def validate_ai_response(response) -> dict:
     """
-    Attempt to fix invalid JSON plan by asking the AI for a correction.
-    
-    Args:
-        raw_plan: The invalid JSON string that needs fixing
-        error_details: Optional error message explaining why the JSON was invalid
-    
-    Returns:
-        str: A valid JSON string containing exactly the keys 'explanation', 'files_modified', and 'codebase_analysis'
+    Validate the AI response locally. The plan call is constrained by the PLAN_TOOL schema,
+    so no correction round-trip is made; a response that still fails validation is
+    wrapped in a fallback plan instead.
+    The plan is passed on as a dict, so it is decoded at most once on the way to display;
+    a JSON string is still accepted.
     """
-    error_context = f" Error: {error_details}" if error_details else ""
+    if isinstance(response, dict):
+        response_json = response
+    else:
+        try:
+            response_json = json_loads(response)
+        except json.JSONDecodeError as e:
+            logging.error(f"JSON parsing failed: {str(e)}")
+            return fallback_plan(response)
     
-    message = {
-        "role": "user",
-        "content": f"""The following plan data failed validation.{error_context}
-Please provide a corrected JSON object that STRICTLY follows this schema:
-
-{{
-    "explanation": "string describing the task and approach",
-    "files_modified": [
-        // Each item must be either a string or an object with "path" and "changes"
-        "path/to/file.ext",
-        {{
-            "path": "path/to/file.ext",
-            "changes": [
-                {{
-                    "line_range": "line_range",
-                    "action": "action",
-                    "description": "why this file needs modification"
-                }}
-            ]
-        }}
-    ],
-    "codebase_analysis": {{
-        "current_state": "description of current implementation",
-        "recommendations": [
-            "list of specific recommendations"
-        ]
-    }}
-}}
-
-IMPORTANT:
-1. The response MUST be valid JSON
-2. ONLY these three top-level keys are allowed
-3. The types must match exactly as shown
-4. No additional keys are permitted
-
-Raw content to fix:
-{raw_plan}"""
-    }
+    if validate_json_schema(response_json):
+        return response_json
     
-    try:
-        response = await anthropic_message_create(
-            max_tokens=1024,
-            messages=[message],
-            model="claude-3-5-sonnet-latest"
-        )
-        
-        # Extract JSON from response
-        content = response.content[0].text
-        json_start = content.find('{')
-        json_end = content.rfind('}') + 1
-        
-        if json_start != -1 and json_end != -1:
-            json_str = content[json_start:json_end]
-            fixed_json = json.loads(json_str)
-            # Check that the fixed JSON contains exactly the required keys
-            required_keys = {"explanation", "files_modified", "codebase_analysis"}
-            if set(fixed_json.keys()) == required_keys:
-                return json.dumps(fixed_json, indent=2)
-        
-        logging.error("AI response did not return valid JSON with exactly the required keys")
-        return None
-    except Exception as e:
-        logging.error(f"Error fixing JSON plan: {str(e)}")
-        return None
+    logging.error("JSON schema validation failed for AI response")
+    raw_response = response if isinstance(response, str) else json_dumps(response, indent=True)
+    return fallback_plan(raw_response)
 
 async def correct_recommended_changes(raw_changes: dict) -> dict:
     """
@@ -700,7 +976,7 @@ async def correct_recommended_changes(raw_changes: dict) -> dict:
         Each change should be an object with keys 'location', 'suggestion', and 'benefit'.
         Please provide a corrected JSON object.
         
-        Raw data: {json.dumps(raw_changes)}"""
+        Raw data: {to_prompt_json(raw_changes)}"""
     }
     
     try:
@@ -710,16 +986,10 @@ async def correct_recommended_changes(raw_changes: dict) -> dict:
             model="claude-3-5-sonnet-latest"
         )
         
-        content = response.content[0].text
-        json_start = content.find('{')
-        json_end = content.rfind('}') + 1
-        
-        if json_start != -1 and json_end != -1:
-            json_str = content[json_start:json_end]
-            corrected = json.loads(json_str)
-            
+        corrected = extract_json(response.content[0].text)
+        if corrected is not None:
             # Verify the corrected format
-            if isinstance(corrected, dict) and all(
+            if all(
                 isinstance(change, dict) and 
                 all(key in change for key in ['location', 'suggestion', 'benefit'])
                 for change in corrected.values()
@@ -732,6 +1002,26 @@ async def correct_recommended_changes(raw_changes: dict) -> dict:
         logging.error(f"Error correcting recommended changes: {str(e)}")
         return raw_changes
 
+## AI corrections of malformed recommended changes are memoized by a hash of the changes,
+## so formatting the same changes again does not repeat the correction round trip.
+CORRECTION_CACHE_ENTRIES = 16
+_correction_cache = {}
+
+def correction_cache_key(changes: dict) -> str:
+    """Key a correction on a hash of the canonical JSON of the changes it was made for."""
+    return hashlib.blake2b(json_dumps(changes, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+async def cached_correct_recommended_changes(changes: dict) -> dict:
+    """correct_recommended_changes, reusing an earlier correction of the same changes."""
+    key = correction_cache_key(changes)
+    corrected = _correction_cache.get(key)
+    if corrected is None:
+        corrected = await correct_recommended_changes(changes)
+        if len(_correction_cache) >= CORRECTION_CACHE_ENTRIES:
+            del _correction_cache[next(iter(_correction_cache))]
+        _correction_cache[key] = corrected
+    return corrected
+
 async def format_recommended_changes(changes: dict) -> Table:
     """Format the recommended changes section as a table."""
     table = Table(title="Recommended Changes", show_header=True, header_style="bold magenta")
@@ -753,7 +1043,7 @@ async def format_recommended_changes(changes: dict) -> Table:
             break
     
     if needs_correction:
-        changes = await correct_recommended_changes(changes)
+        changes = await cached_correct_recommended_changes(changes)
     
     # Add rows to table
     for key, change in changes.items():
@@ -772,11 +1062,10 @@ def format_current_implementation(implementation: dict) -> Panel:
     """
     Format the current implementation section in a Panel.
     """
-    from rich.panel import Panel  # Ensure Panel is imported
     if not implementation:
-        return Panel("No implementation details provided", title="Current Implementation", border_style="blue")
+        return _BLUE_PANEL("No implementation details provided", title="Current Implementation")
     content = "\n".join(f"{key}: {value}" for key, value in implementation.items())
-    return Panel(content, title="Current Implementation", border_style="blue")
+    return _BLUE_PANEL(content, title="Current Implementation")
 
 async def display_json_data(json_data: dict):
     """Display the JSON data with rich formatting."""
@@ -817,109 +1106,171 @@ async def display_json_data(json_data: dict):
     console.print("\n[bold green]Please review the formatted JSON data.[/bold green]")
 
 
-async def display_final_plan(plan: str):
-    """Display the final plan as bullet points rather than raw JSON."""
+## The plan reaches display_final_plan in one of a few shapes; dispatch on the exact type
+## with a single dict lookup, falling back to isinstance for subclasses such as OrderedDict.
+_PLAN_LOADERS = {
+    # orjson rejects str subclasses; str() returns an exact str unchanged
+    str: lambda plan: json_loads(str(plan)),
+    dict: lambda plan: plan,
+    list: lambda plan: load_plan_data(plan[0]),
+    TextBlock: lambda block: json_loads(block.text),
+}
+_RECOMMENDATION_ROWS = {str: lambda rec: [rec]}
+
+def lookup_by_type(table: dict, value, default=None):
+    """Return the table entry for value's exact type, else the first entry it is an instance of."""
+    entry = table.get(type(value))
+    if entry is None:
+        entry = next((entry for cls, entry in table.items() if isinstance(value, cls)), default)
+    return entry
+
+def load_plan_data(plan) -> dict:
+    """Convert a plan given as a JSON string, a dict, a TextBlock or a list holding one into a dict."""
+    loader = lookup_by_type(_PLAN_LOADERS, plan)
+    if loader is None:
+        raise TypeError("Plan must be a string, a list containing a string, or a dictionary.")
+    return loader(plan)
+
+async def display_final_plan(plan: dict):
+    """
+    Display the final plan as bullet points rather than raw JSON.
+    Rendering is synchronous Rich work, so it runs in a worker thread to keep the event loop free.
+    """
+    await asyncio.to_thread(render_final_plan, plan)
+
+def render_final_plan(plan: dict):
+    """Synchronously render the final plan to the console."""
     try:
         with Status("[bold blue]Formatting task plan...", console=console):
             # Convert the plan input into a dictionary.
-            if isinstance(plan, list):
-                if isinstance(plan[0], TextBlock):
-                    plan_data = json.loads(plan[0].text)
-                elif isinstance(plan[0], dict):
-                    plan_data = plan[0]
-                else:
-                    plan_data = json.loads(plan[0])
-            elif isinstance(plan, str):
-                plan_data = json.loads(plan)
-            elif isinstance(plan, dict):
-                plan_data = plan
-            else:
-                raise TypeError("Plan must be a string, a list containing a string, or a dictionary.")
+            plan_data = load_plan_data(plan)
 
-            console.clear()
-            console.print("\n[bold cyan]Task Plan Summary[/bold cyan]", justify="center")
-            console.print("=" * 80, justify="center")
-            console.print("\n[white]Based on the code analysis, here are the key areas for optimization:[/white]\n")
-            
-            # Display the explanation as a panel.
-            explanation = plan_data.get("explanation", "No explanation provided")
-            console.print(Panel(explanation, title="Task Explanation", border_style="blue"))
-            console.print()
-            
-            # Display files to be modified with their changes
-            files_modified = plan_data.get("files_modified", [])
-            if files_modified:
-                files_table = Table(title="Files to be Modified", show_header=True, header_style="bold magenta")
-                files_table.add_column("File Path", style="cyan")
-                files_table.add_column("Changes", style="green")
-                
-                import os
-                previous_group = None
-                for file in files_modified:
-                    if isinstance(file, dict):
-                        path = file.get('path', 'Unknown')
-                        # Group files using the file basename (excluding extension)
-                        current_group = os.path.splitext(os.path.basename(path))[0]
-                        if previous_group is not None and current_group != previous_group:
-                            # Insert a blank row to dynamically add space/indent between different file groups
-                            files_table.add_row("", "")
-                        previous_group = current_group
-                        changes = file.get('changes', [])
-                        changes_text = ""
-                        for change in changes:
-                            changes_text += f"• Lines {change.get('line_range', 'N/A')}: "
-                            changes_text += f"{change.get('action', 'N/A')} - "
-                            changes_text += f"{change.get('description', 'No description')}\n"
-                        files_table.add_row(path, changes_text.strip())
-                    else:
-                        files_table.add_row(str(file), "No changes specified")
-                
-                console.print(files_table)
-                console.print()
-
-            # Display codebase analysis
-            analysis = plan_data.get("codebase_analysis", {})
-            if isinstance(analysis, dict):
-                current_state = analysis.get('current_state', 'No current state information available')
-                recommendations = analysis.get('recommendations', [])
-                
-                console.print(Panel(current_state, title="Current State", border_style="yellow"))
-                console.print()
-                
-                if recommendations:
-                    rec_table = Table(title="Recommendations", show_header=False, box=None)
-                    rec_table.add_column("", style="green")
-                    for rec in recommendations:
-                        rec_table.add_row(f"• {rec}")
-                    console.print(rec_table)
-            else:
-                console.print(Panel(str(analysis), title="Codebase Analysis", border_style="yellow"))
+            plan_group = build_plan_group(plan_data)
 
+            console.clear()
+            console.print(plan_group)
             console.print("\n[bold green]Please review the plan and proceed with the necessary actions.[/bold green]")
     except Exception as e:
-        import traceback
-        tb = traceback.format_exc()
-        logging.error(f"Unexpected error in display_final_plan: {str(e)}\nTraceback:\n{tb}")
-        console.print(Panel(
+        logging.error("Unexpected error in display_final_plan: %s", e, exc_info=True)
+        console.print(_RED_PANEL(
             f"[red]An unexpected error occurred:[/red]\n{str(e)}",
-            title="Error",
-            border_style="red"
+            title="Error"
         ))
 
+def build_plan_group(plan_data: dict) -> Group:
+    """Build the Rich Group that renders a plan: its explanation, file changes and analysis."""
+    # Every section is collected into one Group and rendered with a single print
+    renderables = [
+        Text.from_markup("\n[bold cyan]Task Plan Summary[/bold cyan]", justify="center"),
+        Text("=" * 80, justify="center"),
+        Text.from_markup("\n[white]Based on the code analysis, here are the key areas for optimization:[/white]\n"),
+    ]
+    
+    # Display the explanation as a panel.
+    # Sections with empty content are skipped rather than laid out as empty panels
+    explanation = plan_data.get("explanation", "No explanation provided")
+    if explanation:
+        renderables.append(_BLUE_PANEL(explanation, title="Task Explanation"))
+        renderables.append(Text())
+    
+    # Display files to be modified with their changes
+    files_modified = plan_data.get("files_modified", [])
+    if files_modified:
+        files_table = Table(title="Files to be Modified", show_header=True, header_style="bold magenta")
+        files_table.add_column("File Path", style="cyan")
+        files_table.add_column("Changes", style="green")
+        
+        import os
+        previous_group = None
+        for file in files_modified:
+            if isinstance(file, dict):
+                path = file.get('path', 'Unknown')
+                # Group files using the file basename (excluding extension)
+                current_group = os.path.splitext(os.path.basename(path))[0]
+                if previous_group is not None and current_group != previous_group:
+                    # Insert a blank row to dynamically add space/indent between different file groups
+                    files_table.add_row("", "")
+                previous_group = current_group
+                changes = file.get('changes', [])
+                # Build the cell from one row per change with a single join rather than repeated +=
+                changes_text = "\n".join(
+                    f"• Lines {change.get('line_range', 'N/A')}: "
+                    f"{change.get('action', 'N/A')} - "
+                    f"{change.get('description', 'No description')}"
+                    for change in changes
+                )
+                files_table.add_row(path, changes_text.strip())
+            else:
+                files_table.add_row(str(file), "No changes specified")
+        
+        renderables.append(files_table)
+        renderables.append(Text())
+
+    # Display codebase analysis
+    analysis = plan_data.get("codebase_analysis", {})
+    if isinstance(analysis, dict):
+        current_state = analysis.get('current_state', 'No current state information available')
+        recommendations = analysis.get('recommendations', [])
+        
+        if current_state:
+            renderables.append(_YELLOW_PANEL(current_state, title="Current State"))
+            renderables.append(Text())
+        
+        if recommendations:
+            rec_table = Table(title="Recommendations", show_header=False, box=None)
+            rec_table.add_column("", style="green")
+            # A single recommendation string is one row, not one row per character
+            for rec in lookup_by_type(_RECOMMENDATION_ROWS, recommendations, list)(recommendations):
+                rec_table.add_row(f"• {rec}")
+            renderables.append(rec_table)
+    elif analysis:
+        renderables.append(_YELLOW_PANEL(str(analysis), title="Codebase Analysis"))
+
+    return Group(*renderables)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Explore a codebase and plan a task with Claude.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always call the API instead of reusing cached responses")
+    return parser.parse_args()
+
 async def main():
-    from persistent_cache import init_persistent_cache, get_cache, set_cache
-    await init_persistent_cache()
-    task_description = input("Enter the task description: ")
-    codebase_summary = await explore_codebase(
-        task_description=task_description,
-        get_cache=get_cache,
-        set_cache=set_cache
+    global response_cache_enabled
+    response_cache_enabled = not parse_args().no_cache
+    from persistent_cache import (
+        init_persistent_cache, get_cache, get_cache_many, set_cache, set_cache_many, close_persistent_cache
     )
-    console.print(f"[green]Found {len(codebase_summary)} relevant files in the codebase.[/green]")
-    plan = await generate_task_plan(task_description, codebase_summary)
-    valid_plan = await validate_ai_response(plan)
-    await display_final_plan(valid_plan)
-    print_anthropic_cost()
+    # The client is created later, so load .env here for the settings read before it
+    load_env_file()
+    io_threads = env_int("TRAYCER_IO_THREADS", DEFAULT_IO_THREADS)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=io_threads))
+    scan_executor = get_process_executor()
+    # Fail on a missing API key before the user types a task, as it did when created at import
+    get_client()
+    # Initialize the cache database and walk the tree while the user is typing the task description
+    cache_task = asyncio.create_task(init_persistent_cache())
+    walk_task = asyncio.create_task(asyncio.to_thread(walk_codebase))
+    try:
+        task_description = await asyncio.to_thread(input, "Enter the task description: ")
+        await cache_task
+        codebase_summary = await explore_codebase(
+            walked_files=await walk_task,
+            task_description=task_description,
+            get_cache=get_cache,
+            set_cache=set_cache,
+            get_cache_many=get_cache_many,
+            set_cache_many=set_cache_many,
+            scan_executor=scan_executor
+        )
+        console.print(f"[green]Found {len(codebase_summary)} relevant files in the codebase.[/green]")
+        plan = await generate_task_plan(task_description, codebase_summary)
+        valid_plan = await validate_ai_response(plan)
+        await display_final_plan(valid_plan)
+        print_anthropic_cost()
+    finally:
+        # Persist the deferred cache access times and stop the connection's worker thread,
+        # before the window can be closed at the prompt below
+        await close_persistent_cache()
     # Add a prompt to keep the console window open in the executable
     input("Press Enter to exit...")
 
@@ -2,210 +2,563 @@ import os
 import logging
 import asyncio
 import re
-import aiofiles
-from typing import List, Dict, Any
+import mmap
+import hashlib
+import time
+from typing import List, Dict, Any, Optional, Pattern, Iterator, Tuple, NamedTuple, Union
 from collections import deque
+from itertools import islice
+from functools import lru_cache
+from concurrent.futures import Executor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 # Configure logging
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Exploration constants, built once at import time
+IGNORED_DIRECTORIES = frozenset({'.git', 'node_modules', '__pycache__', 'venv', '.pytest_cache'})
+CODE_EXTENSIONS = frozenset({'.py', '.js', '.ts', '.jsx', '.tsx'})
+
+# Task keywords are words longer than three characters; re.ASCII skips the Unicode
+# tables, matching the scanner whose bytes regex only folds ASCII case anyway
+_WORD_RE = re.compile(r'\b\w{4,}\b', re.ASCII)
+_FILE_PATTERN_RE = re.compile(r'\b\w+\.[a-zA-Z]+\b|\b\w+(?=\s+file)\b|\b\w+(?=\s+changes)\b', re.ASCII)
+
+## Scanning limits: snippets beyond the cap only bloat the prompt without changing the
+## ranking, and large non-target files (lockfiles, bundles) are not worth scanning.
+MAX_SNIPPETS_PER_FILE = 20
+MAX_SCAN_SIZE = 1024 * 1024  # 1MB
+CONTEXT_LINES = 5  # Matched line plus the four lines before it
+MMAP_MIN_SIZE = 4 * 1024  # Smaller files are read rather than mapped
+PREFILTER_CHUNK = 1024 * 1024  # Bytes lowercased at a time by the literal prefilter
+
+## Directories are listed concurrently; the threads mostly wait on readdir and stat.
+WALK_WORKERS = 16
+
+def _read_file_snippet_sync(file_path: str, start_line: int, num_lines: int) -> str:
+    """
+    Synchronously read `num_lines` lines starting at `start_line`.
+    islice skips the leading lines in C, and only line endings are stripped so indentation survives.
+    """
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+        return '\n'.join(line.rstrip('\r\n') for line in islice(f, start_line, start_line + num_lines))
+
 async def read_file_snippet(file_path, start_line=0, num_lines=10):
     """
     Asynchronously reads a snippet of lines from a file starting at a specific line.
+    The whole read is dispatched to a worker thread in a single hop.
     """
-    lines = []
     try:
-        async with aiofiles.open(file_path, 'r', encoding='utf-8', errors='replace') as f:
-            # Skip to start_line
-            for _ in range(start_line):
-                await f.readline()
-            # Read requested lines
-            for _ in range(num_lines):
-                line = await f.readline()
-                if not line:
-                    break
-                lines.append(line.strip())
+        return await asyncio.to_thread(_read_file_snippet_sync, file_path, start_line, num_lines)
     except Exception as e:
         logging.error(f"Error reading file {file_path}: {str(e)}")
         return f"Error reading file: {str(e)}"
-    return '\n'.join(lines)
+
+def _read_file_content_sync(file_path: str, max_size: int) -> str:
+    """
+    Synchronously read up to `max_size` characters of a file, marking truncation.
+    """
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+        content = f.read(max_size + 1)
+    if len(content) > max_size:
+        return content[:max_size] + "\n... (file truncated due to size)"
+    return content
 
 async def read_file_content(file_path: str, max_size: int = 100 * 1024) -> str:
     """
     Read the full content of a file, with size limit.
     Returns the file content or a truncated version if too large.
+    The read runs as one stdlib call in a worker thread rather than through aiofiles.
     """
     try:
-        async with aiofiles.open(file_path, 'r', encoding='utf-8', errors='replace') as f:
-            content = await f.read(max_size + 1)
-            if len(content) > max_size:
-                return content[:max_size] + "\n... (file truncated due to size)"
-            return content
+        return await asyncio.to_thread(_read_file_content_sync, file_path, max_size)
     except Exception as e:
         logging.error(f"Error reading file {file_path}: {str(e)}")
         return f"Error reading file: {str(e)}"
 
-async def scan_file_content(file_path: str, keywords: set) -> List[Dict[str, str]]:
+class KeywordPattern(NamedTuple):
+    """A compiled keyword alternation together with the lowercased literals it was built from."""
+    regex: Pattern[bytes]
+    literals: Tuple[bytes, ...]
+
+@lru_cache(maxsize=8)
+def compile_keyword_pattern(keywords: frozenset) -> Optional[KeywordPattern]:
     """
-    Scan a file for keywords, returning snippets of context.
-    This version uses asynchronous iteration and a deque for a sliding window.
+    Compile task keywords into a single case-insensitive bytes regex alternation,
+    so files can be searched without decoding them first. The literals are kept alongside
+    the regex for the scanner's prefilter.
+    Returns None when there are no keywords, since an empty alternation matches everything.
+    Only whether a line matches matters, so keywords containing a shorter keyword are
+    dropped: every line they would match is already matched by the shorter one.
+    Memoized on the keyword frozenset, so repeated explorations for the same task reuse one
+    pattern object.
+    """
+    if not keywords:
+        return None
+    minimal = []
+    for keyword in sorted({keyword.lower() for keyword in keywords}, key=len):
+        if not any(shorter in keyword for shorter in minimal):
+            minimal.append(keyword)
+    literals = tuple(keyword.encode('utf-8') for keyword in minimal)
+    return KeywordPattern(re.compile(b'|'.join(map(re.escape, literals)), re.IGNORECASE), literals)
+
+@lru_cache(maxsize=8)
+def compile_target_pattern(file_patterns: frozenset) -> Optional[Pattern[str]]:
+    """
+    Compile the file names mentioned in a task into one regex alternation; a file is a target
+    when any of them occurs in its lowercased basename. Returns None when there are none.
+    As with keywords, patterns containing a shorter pattern are dropped.
+    """
+    if not file_patterns:
+        return None
+    minimal = []
+    for pattern in sorted(file_patterns, key=len):
+        if not any(shorter in pattern for shorter in minimal):
+            minimal.append(pattern)
+    return re.compile('|'.join(map(re.escape, minimal)))
+
+def _scan_file_content_sync(file_path: str, keyword_pattern: Optional[Union[KeywordPattern, Pattern[bytes]]],
+                            max_snippets: int = MAX_SNIPPETS_PER_FILE) -> List[Dict[str, str]]:
+    """
+    Synchronously scan a file for keywords, returning each matching line with up to
+    four preceding lines of context. The file is memory-mapped and the regex jumps from
+    match to match, so the cost is proportional to the number of hits rather than lines;
+    files without a single match are never decoded or split into lines.
+    """
+    if keyword_pattern is None:
+        return []
+    with open(file_path, 'rb') as f:
+        return _scan_open_file(f, keyword_pattern, max_snippets)
+
+def _scan_open_file(f, keyword_pattern: Union[KeywordPattern, Pattern[bytes]],
+                    max_snippets: int = MAX_SNIPPETS_PER_FILE) -> List[Dict[str, str]]:
+    """
+    Scan an already open binary file from the start, whatever its current position.
+    Files under MMAP_MIN_SIZE are read outright; larger ones are memory-mapped.
+    """
+    file_size = os.fstat(f.fileno()).st_size
+    if file_size == 0:
+        return []  # mmap cannot map an empty file
+    if file_size < MMAP_MIN_SIZE:
+        # Setting up and tearing down a mapping costs more than reading a small file outright
+        f.seek(0)
+        return _scan_buffer(f.read(), keyword_pattern, max_snippets)
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return _scan_buffer(mm, keyword_pattern, max_snippets)
+
+def _first_literal_offset(buf, literals: Tuple[bytes, ...]) -> int:
+    """
+    Return an offset at or before the first case-insensitive occurrence of any literal, or -1
+    when none occurs. The buffer is lowercased PREFILTER_CHUNK bytes at a time, with chunks
+    overlapping by the longest literal, so a mapped file is never copied whole.
+    """
+    size = len(buf)
+    overlap = max(map(len, literals)) - 1
+    start = 0
+    while True:
+        end = min(start + PREFILTER_CHUNK, size)
+        chunk = buf[start:end].lower()
+        hits = [index for index in map(chunk.find, literals) if index != -1]
+        if hits:
+            # An earlier occurrence may still run past the chunk end, so never start beyond it
+            return min(start + min(hits), end - overlap if end < size else size)
+        if end == size:
+            return -1
+        start = end - overlap
+
+def _scan_buffer(buf, keyword_pattern: Union[KeywordPattern, Pattern[bytes]],
+                 max_snippets: int = MAX_SNIPPETS_PER_FILE) -> List[Dict[str, str]]:
+    """
+    Scan a bytes-like buffer (a mapping or the bytes read from a small file) for keywords,
+    stopping once max_snippets snippets have been collected. A plain compiled pattern is
+    searched as is, without the literal prefilter.
     """
     snippets = []
-    context_window = deque(maxlen=5)  # Store up to 5 lines as context
+    if isinstance(keyword_pattern, KeywordPattern):
+        keyword_pattern, literals = keyword_pattern
+    else:
+        literals = ()
+    pos = 0
+    if literals:
+        # Prefilter: lowercasing and probing each literal with bytes.find is far cheaper than
+        # a full case-insensitive alternation pass over files without a single keyword, and
+        # on a hit the regex can start at the earliest literal instead of the top of the file
+        pos = _first_literal_offset(buf, literals)
+        if pos == -1:
+            return snippets
+    line_number = 0  # 0-based line number of the line starting at counted_to
+    counted_to = 0
+    while len(snippets) < max_snippets:
+        match = keyword_pattern.search(buf, pos)
+        if match is None:
+            break
+        line_start = buf.rfind(b'\n', 0, match.start()) + 1
+        line_end = buf.find(b'\n', match.start())
+        if line_end == -1:
+            line_end = len(buf)
+        line_number += buf[counted_to:line_start].count(b'\n')
+        counted_to = line_start
+
+        # Walk back over at most CONTEXT_LINES - 1 preceding lines
+        context_start = line_start
+        for _ in range(CONTEXT_LINES - 1):
+            if context_start == 0:
+                break
+            context_start = buf.rfind(b'\n', 0, context_start - 1) + 1
+        context_lines = buf[context_start:line_end].split(b'\n')
+
+        snippets.append({
+            'line_range': f"{line_number - len(context_lines) + 1} - {line_number}",
+            'context': '\n'.join(
+                raw.decode('utf-8', errors='replace').strip() for raw in context_lines
+            )
+        })
+        # Resume after the matched line so each line yields at most one snippet
+        pos = line_end + 1
+    return snippets
+
+## Bytes that occur in text files: common control characters plus everything from space up,
+## which includes every byte of a UTF-8 multi-byte sequence.
+TEXTCHARS = bytes({7, 8, 9, 10, 12, 13, 27}) + bytes(range(0x20, 0x100))
+BINARY_BYTE_RATIO = 0.30
+
+def _looks_binary(sample: bytes) -> bool:
+    """
+    Classify a file's initial chunk the way git and grep do: any NUL byte, or more than
+    BINARY_BYTE_RATIO of bytes outside TEXTCHARS, marks it binary. bytes.translate strips
+    the text bytes in C, and unlike a UTF-8 decode this does not misfire on a multi-byte
+    character cut at the chunk edge.
+    """
+    if b'\0' in sample:
+        return True
+    return len(sample.translate(None, TEXTCHARS)) > BINARY_BYTE_RATIO * len(sample)
+
+def _sniff_and_scan_sync(file_path: str, keyword_pattern: Optional[KeywordPattern],
+                         scan: bool, max_snippets: int = MAX_SNIPPETS_PER_FILE) -> Optional[List[Dict[str, str]]]:
+    """
+    Sniff a file for binary content and, if it is text and `scan` is set, scan it for
+    keywords, all through a single open in one worker thread job.
+    Returns None for binary files, otherwise the (possibly empty) list of snippets.
+    """
+    with open(file_path, 'rb') as f:
+        if _looks_binary(f.read(8192)):
+            return None
+        if not scan or keyword_pattern is None:
+            return []
+        try:
+            return _scan_open_file(f, keyword_pattern, max_snippets)
+        except Exception as e:
+            logging.error(f"Error scanning file {file_path}: {e}")
+            return []
+
+async def scan_file_content(file_path: str, keyword_pattern: Optional[Union[KeywordPattern, Pattern[bytes]]],
+                            max_snippets: int = MAX_SNIPPETS_PER_FILE) -> List[Dict[str, str]]:
+    """
+    Scan a file for keywords, returning snippets of context.
+    The read and scan run in one worker thread instead of awaiting every line.
+    """
     try:
-        async with aiofiles.open(file_path, 'r', encoding='utf-8', errors='replace') as f:
-            current_line = 0
-            async for line in f:
-                context_window.append(line.strip())
-                lower_line = line.lower()
-                if any(keyword in lower_line for keyword in keywords):
-                    snippet = {
-                        'line_range': f"{max(0, current_line - len(context_window) + 1)} - {current_line}",
-                        'context': '\n'.join(context_window)
-                    }
-                    snippets.append(snippet)
-                current_line += 1
-        return snippets
+        return await asyncio.to_thread(_scan_file_content_sync, file_path, keyword_pattern, max_snippets)
     except Exception as e:
         logging.error(f"Error scanning file {file_path}: {e}")
         return []
 
-async def process_file(file_path: str, code_extensions: set, text_extensions: set, 
-                       keywords: set, semaphore: asyncio.Semaphore, is_target_file: bool = False) -> Dict[str, Any]:
+def _scan_directory(dir_path: str, ignored_directories: set) -> Tuple[List[Tuple[str, os.stat_result]], List[str]]:
     """
-    Process a single file by gathering metadata and scanning for relevant content.
+    List one directory with os.scandir, returning its (path, stat) files and the subdirectories
+    to descend into. DirEntry caches the stat result, so each file costs a single stat syscall.
     """
-    async with semaphore:
-        try:
-            stat = await asyncio.to_thread(os.stat, file_path)
-            file_size = stat.st_size
-            last_modified = stat.st_mtime
-            file_extension = os.path.splitext(file_path)[1].lower()
-            
-            MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
-            if file_size > MAX_FILE_SIZE:
-                return {
-                    'path': file_path,
-                    'size': file_size,
-                    'extension': file_extension,
-                    'importance': 'high' if is_target_file else 'low',
-                    'last_modified': last_modified,
-                    'snippets': [],
-                    'skip_reason': 'File too large'
-                }
-            
-            # Check if file is binary by reading an initial chunk in binary mode
-            async with aiofiles.open(file_path, 'rb') as f:
-                sample = await f.read(8192)
+    files = []
+    subdirectories = []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
                 try:
-                    sample.decode('utf-8')
-                except UnicodeDecodeError:
-                    return {
-                        'path': file_path,
-                        'size': file_size,
-                        'extension': file_extension,
-                        'importance': 'high' if is_target_file else 'low',
-                        'last_modified': last_modified,
-                        'snippets': [],
-                        'skip_reason': 'Binary file'
-                    }
-
-            # Determine file importance
-            if is_target_file:
-                importance = 'high'
-            elif file_extension in code_extensions:
-                importance = 'medium'
-            elif file_extension in text_extensions:
-                importance = 'low'
-            else:
-                importance = 'low'
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in ignored_directories:
+                            subdirectories.append(entry.path)
+                    elif not entry.is_dir():
+                        files.append((entry.path, entry.stat()))
+                except OSError as e:
+                    logging.error(f"Error reading directory entry {entry.path}: {e}")
+    except OSError as e:
+        logging.error(f"Error scanning directory {dir_path}: {e}")
+    return files, subdirectories
+
+def _walk_files(root_dir: str, ignored_directories: set,
+                max_workers: int = WALK_WORKERS) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Yield (path, stat) for every file under root_dir, listing directories on a thread pool.
+    Each directory found is submitted as soon as its parent has been listed, so readdir and
+    stat latency overlap across directories, which dominates on network filesystems.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {pool.submit(_scan_directory, root_dir, ignored_directories)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirectories = future.result()
+                yield from files
+                pending.update(
+                    pool.submit(_scan_directory, subdirectory, ignored_directories)
+                    for subdirectory in subdirectories
+                )
+
+## Exploration runs a fixed pool of workers fed by a bounded queue, so memory stays
+## O(workers + queue) rather than one pending task per file in the tree.
+EXPLORE_WORKERS = 64
+EXPLORE_QUEUE_SIZE = 256
+
+## Walked files are checked against the persistent cache in batches, so a warm run costs
+## one lookup per batch instead of one per file.
+CACHE_LOOKUP_BATCH = 500
+
+## Cache keys trust mtime and size, which miss a same-size rewrite landing within one
+## timestamp tick (up to 2s on FAT). As git does for racily clean index entries, files
+## modified this close to the scan are not cached, so a stale scan can never be reused.
+RACY_MTIME_WINDOW = 2.0
+
+## Scanning holds the GIL, so threads only overlap its I/O. Files at least this large are
+## worth the pickling round trip to a process pool; smaller ones stay on threads.
+PROCESS_SCAN_MIN_SIZE = 256 * 1024
+
+def walk_codebase(root_dir: str = '.') -> List[Tuple[str, os.stat_result]]:
+    """
+    Walk the codebase ahead of time, returning (path, stat) for every file outside the ignored
+    directories. The walk does not depend on the task, so it can run before the task is known
+    and be handed to explore_codebase as walked_files.
+    """
+    return list(_walk_files(root_dir, IGNORED_DIRECTORIES))
+
+def task_keywords(task_description: str) -> frozenset:
+    """The lowercased keywords a task description is scanned and scored for."""
+    return frozenset(_WORD_RE.findall(task_description.lower()))
+
+def keyword_fingerprint(keywords: frozenset) -> str:
+    """
+    Short, run-independent digest of a keyword set; snippets depend on the keywords, so it is
+    part of every file cache key.
+    """
+    return hashlib.blake2b('\0'.join(sorted(keywords)).encode('utf-8'), digest_size=8).hexdigest()
 
-            snippets = []
-            if importance != 'low':
-                snippets = await scan_file_content(file_path, keywords)
+def file_cache_key(file_path: str, stat: os.stat_result, fingerprint: str = '',
+                   is_target_file: bool = False) -> str:
+    """
+    Build the persistent cache key for a file: any change to its mtime or size invalidates the entry.
+    The keyword fingerprint and target flag are included because the cached snippets and
+    importance depend on them, so a different task never reuses another task's scan.
+    """
+    return f"{file_path}:{stat.st_mtime_ns}:{stat.st_size}:{fingerprint}:{int(is_target_file)}"
 
+async def process_file(file_path: str, code_extensions: frozenset,
+                       keyword_pattern: Optional[KeywordPattern], is_target_file: bool = False,
+                       stat: Optional[os.stat_result] = None,
+                       scan_executor: Optional[Executor] = None,
+                       max_scan_size: int = MAX_SCAN_SIZE,
+                       max_snippets: int = MAX_SNIPPETS_PER_FILE) -> Dict[str, Any]:
+    """
+    Process a single file by gathering metadata and scanning for relevant content.
+    Pass the stat result from the directory walk to avoid stat'ing the file again.
+    Files of at least PROCESS_SCAN_MIN_SIZE bytes are scanned on scan_executor when one is given.
+    Non-target files larger than max_scan_size are not scanned, and at most max_snippets
+    snippets are kept per file.
+    """
+    try:
+        if stat is None:
+            # A stat is a microsecond syscall, far cheaper than a thread hop
+            stat = os.stat(file_path)
+        file_size = stat.st_size
+        last_modified = stat.st_mtime
+        file_extension = os.path.splitext(file_path)[1].lower()
+        
+        MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+        if file_size > MAX_FILE_SIZE:
+            return {
+                'path': file_path,
+                'size': file_size,
+                'extension': file_extension,
+                'importance': 'high' if is_target_file else 'low',
+                'last_modified': last_modified,
+                'snippets': [],
+                'skip_reason': 'File too large'
+            }
+        
+        # Determine file importance; text files and unknown extensions are both low
+        importance = 'high' if is_target_file else ('medium' if file_extension in code_extensions else 'low')
+
+        # Extensionless text files (Dockerfile, Makefile, scripts) are usually code, so scan them too;
+        # dotfiles such as .env are left alone since they tend to hold secrets
+        should_scan = importance != 'low' or (
+            not file_extension and not os.path.basename(file_path).startswith('.')
+        )
+        too_large_to_scan = should_scan and importance != 'high' and file_size > max_scan_size
+
+        # The binary sniff and the keyword scan share one open in one worker job. The scan holds
+        # the GIL, so large files go to the process pool where they can run in parallel
+        scan = should_scan and not too_large_to_scan
+        if scan and scan_executor is not None and file_size >= PROCESS_SCAN_MIN_SIZE:
+            snippets = await asyncio.get_running_loop().run_in_executor(
+                scan_executor, _sniff_and_scan_sync, file_path, keyword_pattern, scan, max_snippets
+            )
+        else:
+            snippets = await asyncio.to_thread(
+                _sniff_and_scan_sync, file_path, keyword_pattern, scan, max_snippets
+            )
+        if snippets is None:
+            return {
+                'path': file_path,
+                'size': file_size,
+                'extension': file_extension,
+                'importance': 'high' if is_target_file else 'low',
+                'last_modified': last_modified,
+                'snippets': [],
+                'skip_reason': 'Binary file'
+            }
+
+        if too_large_to_scan:
             return {
                 'path': file_path,
                 'size': file_size,
                 'extension': file_extension,
                 'importance': importance,
                 'last_modified': last_modified,
-                'snippets': snippets
+                'snippets': [],
+                'skip_reason': 'File too large to scan'
             }
-        except Exception as e:
-            logging.error(f"Error processing file {file_path}: {e}")
-            return {'path': file_path, 'error': str(e)}
+
+        return {
+            'path': file_path,
+            'size': file_size,
+            'extension': file_extension,
+            'importance': importance,
+            'last_modified': last_modified,
+            'snippets': snippets
+        }
+    except Exception as e:
+        logging.error(f"Error processing file {file_path}: {e}")
+        return {'path': file_path, 'error': str(e)}
 
 async def explore_codebase(root_dir: str = '.', task_description: str = '', 
-                          get_cache=None, set_cache=None) -> List[Dict[str, Any]]:
+                          get_cache=None, set_cache=None, get_cache_many=None,
+                          set_cache_many=None, scan_executor: Optional[Executor] = None,
+                          walked_files: Optional[List[Tuple[str, os.stat_result]]] = None,
+                          max_scan_size: int = MAX_SCAN_SIZE,
+                          max_snippets: int = MAX_SNIPPETS_PER_FILE) -> List[Dict[str, Any]]:
     """
     Explores codebase focusing on potentially relevant files based on task keywords.
+    Cache lookups are made CACHE_LOOKUP_BATCH keys at a time through get_cache_many when
+    it is given; otherwise the per-key get_cache lookups are gathered for each batch.
+    New results are written once at the end through set_cache_many, or set_cache per key.
+    Pass a ProcessPoolExecutor as scan_executor to scan large files on multiple cores, and
+    the result of walk_codebase as walked_files to skip walking root_dir here.
+    max_scan_size and max_snippets bound the work per file; see process_file.
     """
-    keywords = set(re.findall(r'\b\w+\b', task_description.lower()))
-    keywords = {word for word in keywords if len(word) > 3}
-    
-    file_patterns = set(re.findall(r'\b\w+\.[a-zA-Z]+\b|\b\w+(?=\s+file)\b|\b\w+(?=\s+changes)\b', task_description.lower()))
+    racy_cutoff = time.time() - RACY_MTIME_WINDOW
+    task_text = task_description.lower()
+    keywords = task_keywords(task_description)
+    keyword_pattern = compile_keyword_pattern(keywords)
+    # The limits shape the cached snippets too, so results scanned under other limits are not reused
+    fingerprint = f"{keyword_fingerprint(keywords)}-{max_scan_size}-{max_snippets}"
     
-    ignored_directories = {'.git', 'node_modules', '__pycache__', 'venv', '.pytest_cache'}
-    code_extensions = {'.py', '.js', '.ts', '.jsx', '.tsx'}
-    text_extensions = code_extensions.union({'.json', '.txt', '.md', '.html', '.css', '.xml', '.csv'})
+    target_pattern = compile_target_pattern(frozenset(_FILE_PATTERN_RE.findall(task_text)))
     
-    semaphore = asyncio.Semaphore(100)
-    tasks = []
-
-    async def return_cached(result):
-        return result
-
-    for root, dirs, files in os.walk(root_dir):
-        dirs[:] = [d for d in dirs if d not in ignored_directories]
-        for file in files:
-            file_path = os.path.join(root, file)
-            file_name = os.path.basename(file_path).lower()
-            file_name_no_ext = os.path.splitext(file_name)[0]
-            
-            is_target_file = any(
-                pattern in file_name or pattern == file_name_no_ext
-                for pattern in file_patterns
+    use_cache = bool((get_cache or get_cache_many) and (set_cache or set_cache_many))
+    if use_cache and get_cache_many is None:
+        async def get_cache_many(keys):
+            values = await asyncio.gather(*(get_cache(key) for key in keys))
+            return {key: value for key, value in zip(keys, values) if value}
+    if use_cache and set_cache_many is None:
+        async def set_cache_many(items):
+            await asyncio.gather(*(set_cache(key, value) for key, value in items))
+    cache_updates = []
+    cached_results = []
+    results = []
+    queue = asyncio.Queue(maxsize=EXPLORE_QUEUE_SIZE)
+
+    async def worker():
+        # Pull files off the bounded queue until the producer sends a None sentinel
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            file_path, is_target_file, stat, cache_key = item
+            result = await process_file(
+                file_path, 
+                CODE_EXTENSIONS, 
+                keyword_pattern, 
+                is_target_file,
+                stat,
+                scan_executor,
+                max_scan_size,
+                max_snippets
+            )
+            # Successful results are written back in one batch once exploration finishes
+            if cache_key is not None and 'error' not in result and stat.st_mtime < racy_cutoff:
+                cache_updates.append((cache_key, result))
+            results.append(result)
+
+    async def flush(pending):
+        # Resolve a batch of walked files against the cache in one lookup and queue the misses
+        cached = await get_cache_many([cache_key for _, _, _, cache_key in pending])
+        for item in pending:
+            file_path, is_target_file, _, cache_key = item
+            cached_result = cached.get(cache_key)
+            if cached_result:
+                # Print a message indicating the file is being read from the persistent cache (SQLite)
+                print(f"[INFO] File read from persistent cache: {file_path} (no tokens used)")
+                cached_results.append(cached_result)
+            else:
+                await queue.put(item)
+
+    # The TaskGroup ties the workers to the producer: if either side fails, the rest are
+    # cancelled instead of leaving the producer blocked on a full queue
+    async with asyncio.TaskGroup() as workers:
+        for _ in range(EXPLORE_WORKERS):
+            workers.create_task(worker())
+        pending = []
+
+        async def admit(file_path, stat):
+            nonlocal pending
+            # Matching the name without its extension is implied: it is a prefix of the name
+            is_target_file = bool(
+                target_pattern and target_pattern.search(os.path.basename(file_path).lower())
             )
             
-            if get_cache and set_cache:
-                cache_key = f"{file_path}:{os.path.getmtime(file_path)}"
-                cached_result = await get_cache(cache_key)
-                
-                if cached_result:
-                    # Print a message indicating the file is being read from the persistent cache (SQLite)
-                    print(f"[INFO] File read from persistent cache: {file_path} (no tokens used)")
-                    if is_target_file:
-                        cached_result['importance'] = 'high'
-                    tasks.append(asyncio.create_task(return_cached(cached_result)))
-                    continue
+            if not use_cache:
+                await queue.put((file_path, is_target_file, stat, None))
+                return
             
-            tasks.append(process_file(
-                file_path, 
-                code_extensions, 
-                text_extensions, 
-                keywords, 
-                semaphore,
-                is_target_file
-            ))
+            cache_key = file_cache_key(file_path, stat, fingerprint, is_target_file)
+            pending.append((file_path, is_target_file, stat, cache_key))
+            if len(pending) >= CACHE_LOOKUP_BATCH:
+                await flush(pending)
+                pending = []
+
+        if walked_files is None:
+            walked_files = await asyncio.to_thread(walk_codebase, root_dir)
+        for file_path, stat in walked_files:
+            await admit(file_path, stat)
+        if pending:
+            await flush(pending)
+        for _ in range(EXPLORE_WORKERS):
+            await queue.put(None)
     
-    codebase_summary = await asyncio.gather(*tasks)
+    if cache_updates:
+        await set_cache_many(cache_updates)
     
-    if get_cache and set_cache:
-        for file_summary in codebase_summary:
-            if 'error' not in file_summary:
-                cache_key = f"{file_summary['path']}:{file_summary['last_modified']}"
-                await set_cache(cache_key, file_summary)
+    codebase_summary = cached_results + results
     
     relevant_files = [
         f for f in codebase_summary 
         if isinstance(f, dict) and (f.get('snippets', []) or f.get('importance') == 'high')
     ]
     
+    # The path breaks ties, so the order, and with it every prompt built from it, does not
+    # depend on which directory listing or scan happened to finish first
     relevant_files.sort(
         key=lambda x: (
             x.get('importance') != 'high',
-            -len(x.get('snippets', []))
+            -len(x.get('snippets', [])),
+            x['path']
         )
     )
     
@@ -1,8 +1,23 @@
 import aiosqlite
+import asyncio
 import logging
 import json
 import time
-from typing import Any, Optional
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+# Values are stored as JSON bytes in a BLOB column. orjson serializes straight to bytes and
+# is several times faster than the stdlib json module, which is the fallback without it;
+# both also read the TEXT values written by older versions of the cache.
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(value: Any) -> bytes:
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    _loads = json.loads
 
 # Configure logging
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -13,21 +28,141 @@ CACHE_DB_PATH = 'cache.db'
 MAX_CACHE_SIZE = 100 * 1024 * 1024  # 100MB
 MAX_ENTRIES = 10000
 EVICTION_BATCH = 100
+MEMORY_CACHE_ENTRIES = 10000
+
+# One connection is opened on first use and kept for the life of the process, so cache
+# operations skip the open, schema read and close each time. WAL lets reads proceed during
+# a write, and synchronous=NORMAL is durable in WAL mode without an fsync per commit.
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-20000',  # 20MB page cache
+    'PRAGMA mmap_size=268435456',  # 256MB
+)
+_connection: Optional[aiosqlite.Connection] = None
+_connect_lock = asyncio.Lock()
+# Writers share the connection, so each write transaction holds this lock until it commits
+_write_lock = asyncio.Lock()
+
+async def _get_connection() -> aiosqlite.Connection:
+    """Return the shared connection, opening it and applying SQLITE_PRAGMAS on first use."""
+    global _connection
+    if _connection is None:
+        async with _connect_lock:
+            if _connection is None:
+                db = await aiosqlite.connect(CACHE_DB_PATH)
+                db.row_factory = aiosqlite.Row
+                for pragma in SQLITE_PRAGMAS:
+                    await db.execute(pragma)
+                _connection = db
+    return _connection
+
+@asynccontextmanager
+async def _reader():
+    """Yield the shared connection for reads."""
+    yield await _get_connection()
+
+@asynccontextmanager
+async def _writer():
+    """Yield the shared connection for one write transaction, rolling it back if the block fails."""
+    async with _write_lock:
+        db = await _get_connection()
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
+
+async def close_persistent_cache():
+    """Flush deferred access times and close the shared connection; its worker thread would otherwise keep the process alive."""
+    global _connection
+    await flush_access_times()
+    if _connection is not None:
+        db, _connection = _connection, None
+        await db.close()
+
+# In-memory LRU tier in front of SQLite, holding serialized values so callers
+# that mutate a returned value never corrupt the cached copy
+_memory_cache: "OrderedDict[str, bytes]" = OrderedDict()
+
+def _remember(key: str, serialized_value: bytes):
+    """Store a serialized value in the in-memory tier, evicting the least recently used entry."""
+    _memory_cache[key] = serialized_value
+    _memory_cache.move_to_end(key)
+    if len(_memory_cache) > MEMORY_CACHE_ENTRIES:
+        _memory_cache.popitem(last=False)
+
+# last_accessed updates are kept in memory and written in one batch with the next cache
+# write (or by flush_access_times), so cache hits, including in-memory ones, stay read-only
+_access_times: Dict[str, int] = {}
+
+def _touch(key: str):
+    """Record a cache hit; the new last_accessed time reaches SQLite on the next flush."""
+    _access_times[key] = int(time.time())
+
+async def _write_access_times(db):
+    """Write the deferred last_accessed times on an open connection; the caller commits."""
+    if not _access_times:
+        return
+    items = [(accessed, key) for key, accessed in _access_times.items()]
+    _access_times.clear()
+    await db.executemany('UPDATE cache SET last_accessed = ? WHERE key = ?', items)
+
+async def flush_access_times():
+    """Write any deferred last_accessed times to SQLite; call before exiting."""
+    if not _access_times:
+        return
+    try:
+        async with _writer() as db:
+            await _write_access_times(db)
+            await db.commit()
+    except Exception as e:
+        logger.error(f"Error flushing cache access times: {e}")
+
+async def _total_size(db) -> int:
+    """Current total size of all cached values, read from the cache_meta running total."""
+    async with db.execute('SELECT total_size FROM cache_meta WHERE id = 1') as cursor:
+        row = await cursor.fetchone()
+        return row[0] if row else 0
+
+async def _add_to_total_size(db, rows):
+    """
+    Adjust the running total for (key, size) rows about to be written. Run it before the
+    INSERT OR REPLACE so a replaced row's old size can still be subtracted.
+    """
+    await db.executemany('''
+        UPDATE cache_meta
+        SET total_size = total_size + ? - COALESCE((SELECT size FROM cache WHERE key = ?), 0)
+        WHERE id = 1
+    ''', [(size, key) for key, size in rows])
 
 async def init_db():
     """Initialize the SQLite database with required tables."""
     try:
-        async with aiosqlite.connect(CACHE_DB_PATH) as db:
+        async with _writer() as db:
             await db.execute('''
                 CREATE TABLE IF NOT EXISTS cache (
                     key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL,
+                    value BLOB NOT NULL,
                     size INTEGER NOT NULL,
                     last_accessed INTEGER NOT NULL,
                     created_at INTEGER NOT NULL
                 )
             ''')
             await db.execute('CREATE INDEX IF NOT EXISTS idx_last_accessed ON cache(last_accessed)')
+            # Running total of cache sizes, so writes never have to SUM every row;
+            # a database created before this table is seeded from its existing rows
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS cache_meta (
+                    id INTEGER PRIMARY KEY,
+                    total_size INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            await db.execute('''
+                INSERT OR IGNORE INTO cache_meta (id, total_size)
+                SELECT 1, COALESCE(SUM(size), 0) FROM cache
+            ''')
             await db.commit()
     except Exception as e:
         logger.error(f"Error initializing cache database: {e}")
@@ -35,7 +170,7 @@ async def init_db():
 
 async def get_cache(key: str) -> Optional[Any]:
     """
-    Retrieve a value from the cache by key.
+    Retrieve a value from the cache by key, checking the in-memory tier before SQLite.
     
     Args:
         key: The cache key to lookup
@@ -43,12 +178,15 @@ async def get_cache(key: str) -> Optional[Any]:
     Returns:
         The cached value if found, None otherwise
     """
+    serialized_value = _memory_cache.get(key)
+    if serialized_value is not None:
+        _memory_cache.move_to_end(key)
+        _touch(key)
+        return _loads(serialized_value)
+
     try:
-        async with aiosqlite.connect(CACHE_DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            
-            # Update last accessed time and retrieve value
-            current_time = int(time.time())
+        async with _reader() as db:
+            # Retrieve value; the last accessed time is recorded in memory and written later
             async with db.execute(
                 'SELECT value FROM cache WHERE key = ?',
                 (key,)
@@ -56,15 +194,11 @@ async def get_cache(key: str) -> Optional[Any]:
                 row = await cursor.fetchone()
                 
                 if row:
-                    # Update last_accessed time
-                    await db.execute(
-                        'UPDATE cache SET last_accessed = ? WHERE key = ?',
-                        (current_time, key)
-                    )
-                    await db.commit()
-                    
                     try:
-                        return json.loads(row['value'])
+                        value = _loads(row['value'])
+                        _remember(key, row['value'])
+                        _touch(key)
+                        return value
                     except json.JSONDecodeError:
                         logger.error(f"Error decoding cached value for key {key}")
                         return None
@@ -75,6 +209,53 @@ async def get_cache(key: str) -> Optional[Any]:
         logger.error(f"Error retrieving from cache: {e}")
         return None
 
+async def get_cache_many(keys: List[str]) -> Dict[str, Any]:
+    """
+    Retrieve several values from the cache in one round trip.
+    
+    Keys found in the in-memory tier are served from there; the rest are fetched with a
+    single read-only SELECT ... IN query. Access times are deferred like get_cache's.
+    
+    Args:
+        keys: The cache keys to lookup
+        
+    Returns:
+        A dict mapping each key that was found to its cached value; missing keys are omitted
+    """
+    found = {}
+    missing = []
+    for key in keys:
+        serialized_value = _memory_cache.get(key)
+        if serialized_value is not None:
+            _memory_cache.move_to_end(key)
+            found[key] = _loads(serialized_value)
+            _touch(key)
+        else:
+            missing.append(key)
+    if not missing:
+        return found
+
+    try:
+        async with _reader() as db:
+            placeholders = ','.join('?' * len(missing))
+            async with db.execute(
+                f'SELECT key, value FROM cache WHERE key IN ({placeholders})',
+                missing
+            ) as cursor:
+                rows = await cursor.fetchall()
+
+        for key, serialized_value in rows:
+            try:
+                found[key] = _loads(serialized_value)
+            except json.JSONDecodeError:
+                logger.error(f"Error decoding cached value for key {key}")
+                continue
+            _remember(key, serialized_value)
+            _touch(key)
+    except Exception as e:
+        logger.error(f"Error retrieving from cache: {e}")
+    return found
+
 async def set_cache(key: str, value: Any) -> bool:
     """
     Store a value in the cache with the given key.
@@ -87,37 +268,89 @@ async def set_cache(key: str, value: Any) -> bool:
         bool: True if successful, False otherwise
     """
     try:
-        # Serialize value to JSON
-        serialized_value = json.dumps(value)
-        value_size = len(serialized_value.encode('utf-8'))
+        # Serialize value to JSON bytes
+        serialized_value = _dumps(value)
+        value_size = len(serialized_value)
         current_time = int(time.time())
         
-        async with aiosqlite.connect(CACHE_DB_PATH) as db:
+        async with _writer() as db:
+            # Deferred access times go in with this write, and before eviction picks its victims
+            await _write_access_times(db)
+            
             # Check current cache size
-            async with db.execute('SELECT SUM(size) as total_size FROM cache') as cursor:
-                row = await cursor.fetchone()
-                current_size = row[0] or 0
+            current_size = await _total_size(db)
                 
             # Perform LRU eviction if needed
             if current_size + value_size > MAX_CACHE_SIZE:
                 await evict_lru_entries(db, value_size)
             
             # Insert or update cache entry
+            await _add_to_total_size(db, [(key, value_size)])
             await db.execute('''
                 INSERT OR REPLACE INTO cache (key, value, size, last_accessed, created_at)
                 VALUES (?, ?, ?, ?, ?)
             ''', (key, serialized_value, value_size, current_time, current_time))
             
             await db.commit()
+            _remember(key, serialized_value)
             return True
             
     except Exception as e:
         logger.error(f"Error setting cache value: {e}")
         return False
 
+async def set_cache_many(items: List[Tuple[str, Any]]) -> bool:
+    """
+    Store several values in the cache with one executemany in a single transaction.
+    
+    Args:
+        items: (key, value) pairs to cache
+        
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    if not items:
+        return True
+    try:
+        current_time = int(time.time())
+        rows = []
+        # Later duplicates win, as they would with one INSERT OR REPLACE each;
+        # deduplicating keeps the running total's per-key adjustment exact
+        for key, value in dict(items).items():
+            serialized_value = _dumps(value)
+            rows.append((key, serialized_value, len(serialized_value), current_time, current_time))
+        required_space = sum(row[2] for row in rows)
+        
+        async with _writer() as db:
+            # Deferred access times go in with this write, and before eviction picks its victims
+            await _write_access_times(db)
+            
+            # Check current cache size
+            current_size = await _total_size(db)
+                
+            # Perform LRU eviction if needed
+            if current_size + required_space > MAX_CACHE_SIZE:
+                await evict_lru_entries(db, required_space)
+            
+            await _add_to_total_size(db, [(row[0], row[2]) for row in rows])
+            await db.executemany('''
+                INSERT OR REPLACE INTO cache (key, value, size, last_accessed, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+            
+            await db.commit()
+        for key, serialized_value, _, _, _ in rows:
+            _remember(key, serialized_value)
+        return True
+            
+    except Exception as e:
+        logger.error(f"Error setting cache values: {e}")
+        return False
+
 async def evict_lru_entries(db, required_space: int):
     """
-    Evict least recently used entries to free up required space.
+    Evict least recently used entries to free up required space. Nothing is committed here:
+    the caller's commit covers the eviction together with the write it makes room for.
     
     Args:
         db: Database connection
@@ -126,26 +359,33 @@ async def evict_lru_entries(db, required_space: int):
     try:
         while True:
             # Get total cache size
-            async with db.execute('SELECT SUM(size) as total_size FROM cache') as cursor:
-                row = await cursor.fetchone()
-                current_size = row[0] or 0
+            current_size = await _total_size(db)
                 
             if current_size + required_space <= MAX_CACHE_SIZE:
                 break
                 
-            # Delete batch of oldest entries
+            # Delete batch of oldest entries, taking their sizes off the running total
             async with db.execute('''
-                DELETE FROM cache 
-                WHERE key IN (
-                    SELECT key FROM cache 
-                    ORDER BY last_accessed ASC 
-                    LIMIT ?
-                )
+                SELECT key, size FROM cache 
+                ORDER BY last_accessed ASC 
+                LIMIT ?
             ''', (EVICTION_BATCH,)) as cursor:
-                if cursor.rowcount == 0:
-                    break
-                    
-            await db.commit()
+                victims = await cursor.fetchall()
+            if not victims:
+                break
+            placeholders = ','.join('?' * len(victims))
+            await db.execute(
+                f'DELETE FROM cache WHERE key IN ({placeholders})',
+                [key for key, _ in victims]
+            )
+            await db.execute(
+                'UPDATE cache_meta SET total_size = total_size - ? WHERE id = 1',
+                (sum(size for _, size in victims),)
+            )
+            # Keep the in-memory tier from serving, or queueing access times for, evicted rows
+            for key, _ in victims:
+                _memory_cache.pop(key, None)
+                _access_times.pop(key, None)
             
     except Exception as e:
         logger.error(f"Error during cache eviction: {e}")